@@ -0,0 +1,48 @@
+# prepares a cpython interpreter to import the device code: puts the
+# micropython stand-in modules on the path and adds the micropython
+# specific functions that phew expects to find on `time` and `gc`
+import gc, os, sys, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHIMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shims")
+
+
+def _ticks_ms():
+  return int(time.monotonic() * 1000) & 0x3FFFFFFF
+
+
+def _ticks_us():
+  return int(time.monotonic() * 1000000) & 0x3FFFFFFF
+
+
+def _ticks_diff(a, b):
+  diff = (a - b) & 0x3FFFFFFF
+  return diff - 0x40000000 if diff & 0x20000000 else diff
+
+
+def _mem_alloc():
+  try:
+    import tracemalloc
+    if tracemalloc.is_tracing():
+      return tracemalloc.get_traced_memory()[0]
+  except ImportError:
+    pass
+  return 0
+
+
+def install():
+  if SHIMS not in sys.path:
+    sys.path.insert(0, SHIMS)
+  if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+  time.ticks_ms = _ticks_ms
+  time.ticks_us = _ticks_us
+  time.ticks_diff = _ticks_diff
+  time.ticks_add = lambda a, b: (a + b) & 0x3FFFFFFF
+  time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+  time.sleep_us = lambda us: time.sleep(us / 1000000)
+
+  gc.threshold = lambda *args: None
+  gc.mem_free = lambda: 192 * 1024
+  gc.mem_alloc = _mem_alloc
@@ -0,0 +1,328 @@
+# host benchmarks for the web server, templates and sd card driver. runs
+# under cpython with the stand-ins in bench/shims, so the numbers are for
+# comparing versions of the code rather than predicting speed on a Pico.
+# the sd figures include the number of commands each operation sent to
+# the emulated card, which doesn't depend on the host at all.
+#
+#   python bench/run.py [--quick] [--output results.json] [--compare old.json]
+import argparse, asyncio, contextlib, io, json, os, platform, random, shutil
+import subprocess, tempfile, time
+
+import hostenv
+hostenv.install()
+
+import sdemu
+
+
+def _percentile(samples, p):
+  index = min(len(samples) - 1, (len(samples) * p) // 100)
+  return samples[index]
+
+
+# summary of a list of per-operation times in seconds
+def _summary(samples, total):
+  samples = sorted(samples)
+  return {
+    "iterations": len(samples),
+    "ops_per_s": round(len(samples) / total, 1) if total else None,
+    "mean_us": round(total / len(samples) * 1e6, 1),
+    "p50_us": round(_percentile(samples, 50) * 1e6, 1),
+    "p95_us": round(_percentile(samples, 95) * 1e6, 1),
+    "max_us": round(samples[-1] * 1e6, 1),
+  }
+
+
+def measure(function, iterations):
+  samples = []
+  start = time.perf_counter()
+  for _ in range(iterations):
+    before = time.perf_counter()
+    function()
+    samples.append(time.perf_counter() - before)
+  return _summary(samples, time.perf_counter() - start)
+
+
+class _Writer:
+  def __init__(self):
+    self.out = bytearray()
+
+  def write(self, data):
+    self.out += data
+
+  async def drain(self):
+    pass
+
+  def close(self):
+    pass
+
+  async def wait_closed(self):
+    pass
+
+  def get_extra_info(self, name):
+    return ("127.0.0.1", 50000)
+
+
+# feeds one raw request through the server's connection handler and
+# returns the raw response
+async def _request(server, raw):
+  from uasyncio import Stream
+  reader = asyncio.StreamReader()
+  reader.feed_data(raw)
+  reader.feed_eof()
+  writer = _Writer()
+  stream = Stream(reader, writer)
+  await server._handle_request(stream, stream)
+  return bytes(writer.out)
+
+
+def _get(path):
+  return f"GET {path} HTTP/1.0\r\nHost: 192.168.4.1\r\n\r\n".encode()
+
+
+def _post(path, form):
+  body = "&".join(f"{name}={value}" for name, value in form.items())
+  return (
+    f"POST {path} HTTP/1.0\r\nHost: 192.168.4.1\r\n"
+    f"Content-Type: application/x-www-form-urlencoded\r\n"
+    f"Content-Length: {len(body)}\r\n\r\n{body}"
+  ).encode()
+
+
+# fills the emulated sd directory with the saves a device typically has
+def _sd_fixture(path, saves=12):
+  shutil.rmtree(path, ignore_errors=True)
+  os.makedirs(path)
+  for number in range(1, saves + 1):
+    with open(f"{path}/save_settings{number}.json", "w") as f:
+      json.dump({"interval": str(number * 5), "name": f"probe{number}"}, f)
+  with open(f"{path}/reading.json", "w") as f:
+    f.write("{}")
+
+
+# imports main.py with the sd card "mounted" on a temporary directory
+def load_app(workdir):
+  os.chdir(workdir)
+  with contextlib.redirect_stdout(io.StringIO()):
+    import main
+  main.APP_TEMPLATE_PATH = os.path.join(hostenv.ROOT, "app_templates")
+  main.SD_MOUNT_PATH = os.path.join(workdir, "sd")
+  main.SD_MOUNTED = True
+  main.sd_index.path = main.SD_MOUNT_PATH
+  _sd_fixture(main.SD_MOUNT_PATH)
+  main.sd_index.build()
+  main.next_save = main.load_save_seq()
+  main.server.set_uploads(main.SD_MOUNT_PATH, storage=main.sd_worker)
+  return main
+
+
+ROUTES = (
+  ("GET /", lambda: _get("/")),
+  ("GET /temperature", lambda: _get("/temperature")),
+  ("GET /toggle", lambda: _get("/toggle")),
+  ("GET /view", lambda: _get("/view")),
+  ("GET /view?prefix", lambda: _get("/view?prefix=save_settings1&limit=2")),
+  ("GET /options", lambda: _get("/options")),
+  ("GET /upload", lambda: _get("/upload")),
+  ("GET /rename-file", lambda: _get("/rename-file")),
+  ("GET /delete-file", lambda: _get("/delete-file")),
+  ("GET /download/<file>", lambda: _get("/download/save_settings3.json")),
+  ("GET /apply", lambda: _get("/apply?file=save_settings3.json")),
+  ("POST /savechanges", lambda: _post("/savechanges", {"interval": "30", "name": "probe"})),
+  ("GET /metrics", lambda: _get("/metrics")),
+  ("GET /logs", lambda: _get("/logs?level=error")),
+  ("GET /missing", lambda: _get("/missing")),
+)
+
+
+def bench_routes(app, iterations):
+  loop = asyncio.new_event_loop()
+  results = {}
+  for name, make_request in ROUTES:
+    # every route starts from the same sd card contents
+    _sd_fixture(app.SD_MOUNT_PATH)
+    app.sd_index.build()
+    app.next_save = app.load_save_seq()
+    raw = make_request()
+    response = loop.run_until_complete(_request(app.server, raw))
+    result = measure(lambda: loop.run_until_complete(_request(app.server, raw)), iterations)
+    result["status"] = int(response.split(b" ", 2)[1])
+    result["response_bytes"] = len(response)
+    results[name] = result
+  loop.close()
+  return results
+
+
+def bench_templates(iterations):
+  from phew import template
+  results = {}
+  path = os.path.join(hostenv.ROOT, "app_templates")
+  cases = (
+    ("index.html", {}),
+    ("save_changes.html", {"transfer_result": "Transfer successful!", "sd_files": "a\nb\nc"}),
+    ("configured.html", {"ssid": "Office", "ip": "192.168.1.20", "show_continue": True}),
+  )
+  for name, kwargs in cases:
+    file = f"{path}/{name}"
+    if not os.path.exists(file):
+      continue
+    size = sum(len(chunk) for chunk in template.render_template(file, **kwargs))
+    result = measure(lambda: sum(1 for _ in template.render_template(file, **kwargs)), iterations)
+    result["output_bytes"] = size
+    result["mb_per_s"] = round(size * result["ops_per_s"] / 1e6, 2)
+    results[name] = result
+  return results
+
+
+def bench_parsing(iterations):
+  from phew import server
+  encoded = "name=Soil+Buddy+%231&ssid=My%20Network%21&password=p%40ss%2Fw0rd&interval=30"
+  plain = "name=probe&ssid=office&password=secret&interval=30&units=metric"
+  return {
+    "urldecode": measure(lambda: server.urldecode(encoded), iterations * 10),
+    "urldecode_plain": measure(lambda: server.urldecode(plain), iterations * 10),
+    "parse_query_string": measure(lambda: server._parse_query_string(encoded), iterations * 10),
+    "parse_query_string_plain": measure(lambda: server._parse_query_string(plain), iterations * 10),
+  }
+
+
+# throughput of the sd card driver against the emulated card, with and
+# without the block cache
+def bench_sd(blocks):
+  import sdcard
+  rng = random.Random(1)
+  data = bytes(rng.getrandbits(8) for _ in range(blocks * 512))
+  offsets = [rng.randrange(blocks) for _ in range(blocks)]
+  results = {}
+  for label, cached in (("sdcard", False), ("blockcache", True)):
+    card, spi, cs = sdemu.make_card(sectors=8192)
+    sd = sdcard.SDCard(spi, cs, max_baudrate=25000000)
+    device = sdcard.BlockCache(sd, sectors=16) if cached else sd
+
+    def operation(name, function, count):
+      commands = card.commands
+      start = time.perf_counter()
+      function()
+      if cached:
+        device.flush()
+      elapsed = time.perf_counter() - start
+      results[f"{label}.{name}"] = {
+        "blocks": count,
+        "blocks_per_s": round(count / elapsed, 1),
+        "kb_per_s": round(count * 512 / 1024 / elapsed, 1),
+        "card_commands": card.commands - commands,
+      }
+
+    def write_single():
+      for block in range(blocks):
+        device.writeblocks(block, data[block * 512:(block + 1) * 512])
+
+    def write_multi():
+      for block in range(0, blocks, 8):
+        device.writeblocks(blocks + block, data[block * 512:(block + 8) * 512])
+
+    def read_single():
+      buffer = bytearray(512)
+      for block in range(blocks):
+        device.readblocks(block, buffer)
+
+    def read_multi():
+      buffer = bytearray(8 * 512)
+      for block in range(0, blocks, 8):
+        device.readblocks(block, buffer)
+
+    def read_random():
+      buffer = bytearray(512)
+      for block in offsets:
+        device.readblocks(block, buffer)
+
+    operation("write_single", write_single, blocks)
+    operation("write_multi8", write_multi, blocks)
+    operation("read_single", read_single, blocks)
+    operation("read_multi8", read_multi, blocks)
+    operation("read_random", read_random, blocks)
+
+    check = bytearray(blocks * 512)
+    sd.readblocks(0, check)
+    assert check == data, "sd card contents don't match what was written"
+  return results
+
+
+def _git_revision():
+  try:
+    return subprocess.check_output(
+      ["git", "describe", "--always", "--dirty"], cwd=hostenv.ROOT,
+      stderr=subprocess.DEVNULL
+    ).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def _rates(results, prefix=""):
+  for key, value in results.items():
+    if isinstance(value, dict):
+      yield from _rates(value, f"{prefix}{key}: ")
+    elif key in ("ops_per_s", "blocks_per_s"):
+      yield prefix[:-2], value
+
+
+# prints the change in every throughput figure from an earlier run
+def compare(previous, current):
+  before = dict(_rates(previous["results"]))
+  print(f"{'benchmark':48} {'before':>12} {'after':>12} {'change':>8}")
+  for name, value in _rates(current["results"]):
+    if name in before and before[name] and value:
+      change = (value - before[name]) / before[name] * 100
+      print(f"{name:48} {before[name]:12.1f} {value:12.1f} {change:+7.1f}%")
+
+
+def main():
+  parser = argparse.ArgumentParser(description="phew / SoilBuddy host benchmarks")
+  parser.add_argument("--quick", action="store_true", help="fewer iterations")
+  parser.add_argument("--output", default=os.path.join(hostenv.ROOT, "bench", "results.json"))
+  parser.add_argument("--compare", help="earlier results file to compare against")
+  parser.add_argument("--only", choices=("routes", "templates", "parsing", "sd"), action="append")
+  args = parser.parse_args()
+
+  iterations = 50 if args.quick else 500
+  blocks = 64 if args.quick else 256
+  only = args.only or ("routes", "templates", "parsing", "sd")
+
+  # logging would mostly measure the terminal
+  from phew import logging
+  logging.disable_logging_types(logging.LOG_ALL)
+
+  workdir = tempfile.mkdtemp(prefix="phew-bench-")
+  results = {}
+  try:
+    if "routes" in only:
+      app = load_app(workdir)
+      results["routes"] = bench_routes(app, iterations)
+    if "templates" in only:
+      results["templates"] = bench_templates(iterations * 4)
+    if "parsing" in only:
+      results["parsing"] = bench_parsing(iterations)
+    if "sd" in only:
+      results["sd"] = bench_sd(blocks)
+  finally:
+    os.chdir(hostenv.ROOT)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+  report = {
+    "revision": _git_revision(),
+    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "python": platform.python_version(),
+    "machine": platform.machine(),
+    "quick": args.quick,
+    "results": results,
+  }
+  with open(args.output, "w") as f:
+    json.dump(report, f, indent=2)
+  print(f"results written to {args.output}")
+
+  if args.compare:
+    with open(args.compare) as f:
+      compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,249 @@
+# in-memory sd card that speaks the SPI mode protocol, so sdcard.SDCard
+# can be driven on a host exactly as it drives a real card. the card
+# answers the commands the driver uses (CMD0/8/9/12/16/17/18/24/25/32/33/
+# 38/55/58/59, ACMD41), checks data and command CRCs once CMD59 has turned
+# them on, and can be made to corrupt reads to exercise retries
+import binascii, random
+from collections import deque
+
+BLOCK = 512
+
+
+def crc7(data):
+  crc = 0
+  for byte in data:
+    for bit in range(7, -1, -1):
+      crc <<= 1
+      if ((byte >> bit) & 1) ^ ((crc >> 7) & 1):
+        crc ^= 0x09
+    crc &= 0x7F
+  return crc
+
+
+def crc16(data):
+  return binascii.crc_hqx(bytes(data), 0)
+
+
+class SDCardEmulator:
+  def __init__(self, sectors=8192, tran_speed=0x32, max_reliable_baudrate=None,
+               corrupt_rate=0.0, seed=0):
+    self.sectors = sectors
+    self.data = bytearray(sectors * BLOCK)
+    self.tran_speed = tran_speed
+    # reads above this spi clock come back corrupted
+    self.max_reliable_baudrate = max_reliable_baudrate
+    # chance of a read block being corrupted at any clock
+    self.corrupt_rate = corrupt_rate
+    self.random = random.Random(seed)
+
+    self.cs = None
+    self.spi = None
+    self.out = deque()
+    self.command = bytearray()
+    self.mode = None
+    self.idle = True
+    self.acmd = False
+    self.crc_on = False
+    self.address = 0
+    self.incoming = bytearray()
+    self.erase_range = [0, 0]
+
+    self.commands = 0
+    self.blocks_read = 0
+    self.blocks_written = 0
+    self.blocks_erased = 0
+    self.corrupted = 0
+
+  def csd(self):
+    csd = bytearray(16)
+    csd[0] = 0x40  # csd version 2.0
+    csd[3] = self.tran_speed
+    c_size = self.sectors // 1024 - 1
+    csd[7] = (c_size >> 16) & 0x3F
+    csd[8] = (c_size >> 8) & 0xFF
+    csd[9] = c_size & 0xFF
+    return csd
+
+  def _data_block(self, payload):
+    payload = bytearray(payload)
+    crc = crc16(payload)
+    corrupt = self.corrupt_rate and self.random.random() < self.corrupt_rate
+    if self.max_reliable_baudrate and self.spi and self.spi.baudrate > self.max_reliable_baudrate:
+      corrupt = True
+    if corrupt:
+      payload[self.random.randrange(len(payload))] ^= 0x10
+      self.corrupted += 1
+    self.out.extend(b"\xff\xfe")
+    self.out.extend(payload)
+    self.out.extend((crc >> 8, crc & 0xFF))
+
+  def _read_block(self, block):
+    self.blocks_read += 1
+    self._data_block(self.data[block * BLOCK:(block + 1) * BLOCK])
+
+  def _respond(self, r1, extra=b""):
+    self.out.append(0xFF)  # Ncr, one byte of delay
+    self.out.append(r1)
+    self.out.extend(extra)
+
+  def _handle_command(self, command):
+    self.commands += 1
+    index = command[0] & 0x3F
+    arg = int.from_bytes(command[1:5], "big")
+    acmd, self.acmd = self.acmd, False
+
+    if self.crc_on or index in (0, 8):
+      if crc7(command[:5]) != command[5] >> 1:
+        self._respond(0x08 | (0x01 if self.idle else 0))
+        return
+
+    busy = 0x01 if self.idle else 0x00
+    if index == 0:
+      self.idle = True
+      self.mode = None
+      self._respond(0x01)
+    elif index == 8:
+      self._respond(0x01, b"\x00\x00\x01\xaa")
+    elif index == 55:
+      self.acmd = True
+      self._respond(busy)
+    elif index == 41 and acmd:
+      self.idle = False
+      self._respond(0x00)
+    elif index == 58:
+      self._respond(busy, b"\xc0\xff\x80\x00")
+    elif index == 59:
+      self.crc_on = bool(arg & 1)
+      self._respond(busy)
+    elif index == 9:
+      self._respond(0x00)
+      self._data_block(self.csd())
+    elif index == 16:
+      self._respond(0x00 if arg == BLOCK else 0x40)
+    elif index == 17:
+      if arg >= self.sectors:
+        self._respond(0x20)
+        return
+      self._respond(0x00)
+      self._read_block(arg)
+    elif index == 18:
+      self._respond(0x00)
+      self.mode = "read_multiple"
+      self.address = arg
+    elif index == 12:
+      self.mode = None
+      self.out.clear()
+      self.out.append(0xFF)  # stuff byte
+      self.out.append(0x00)
+      self.out.extend(b"\x00\x00")  # busy
+    elif index in (24, 25):
+      self._respond(0x00)
+      self.mode = "write_single" if index == 24 else "write_multiple"
+      self.address = arg
+    elif index == 32:
+      self.erase_range[0] = arg
+      self._respond(0x00)
+    elif index == 33:
+      self.erase_range[1] = arg
+      self._respond(0x00)
+    elif index == 38:
+      start, end = self.erase_range
+      self.data[start * BLOCK:(end + 1) * BLOCK] = bytes((end - start + 1) * BLOCK)
+      self.blocks_erased += end - start + 1
+      self._respond(0x00, b"\x00\x00\x00")
+    else:
+      self._respond(0x04 | busy)  # illegal command
+
+  def _receive_data(self, byte):
+    self.incoming.append(byte)
+    if len(self.incoming) < BLOCK + 2:
+      return
+    payload = self.incoming[:BLOCK]
+    crc = self.incoming[BLOCK] << 8 | self.incoming[BLOCK + 1]
+    self.incoming = bytearray()
+    if self.crc_on and crc != crc16(payload):
+      self.out.append(0x0B)  # data rejected, crc error
+      self.mode = None if self.mode == "receive_single" else "write_multiple"
+      return
+    self.data[self.address * BLOCK:(self.address + 1) * BLOCK] = payload
+    self.blocks_written += 1
+    self.address += 1
+    self.out.append(0x05)  # data accepted
+    self.out.extend(b"\x00\x00")  # busy while programming
+    self.mode = None if self.mode == "receive_single" else "write_multiple"
+
+  def _consume(self, byte):
+    if self.mode in ("receive_single", "receive_multiple"):
+      self._receive_data(byte)
+      return
+    if self.mode == "write_single" and byte == 0xFE:
+      self.mode = "receive_single"
+      return
+    if self.mode == "write_multiple":
+      if byte == 0xFC:
+        self.mode = "receive_multiple"
+      elif byte == 0xFD:  # stop transmission token
+        self.mode = None
+        self.out.extend(b"\xff\x00\x00")
+      return
+
+    if not self.command:
+      if byte & 0xC0 != 0x40:
+        return
+    self.command.append(byte)
+    if len(self.command) == 6:
+      command, self.command = self.command, bytearray()
+      self._handle_command(command)
+
+  def exchange(self, byte):
+    if self.cs is not None and self.cs():
+      # deselected, anything the card was still sending is lost
+      self.command = bytearray()
+      self.out.clear()
+      return 0xFF
+    if not self.out and self.mode == "read_multiple":
+      self._read_block(self.address)
+      self.address += 1
+    out = self.out.popleft() if self.out else 0xFF
+    self._consume(byte)
+    return out
+
+
+# machine.SPI stand-in wired to an emulated card
+class EmulatedSPI:
+  def __init__(self, card, cs):
+    self.card = card
+    self.baudrate = 100000
+    card.spi = self
+    card.cs = cs
+
+  def init(self, baudrate=1000000, phase=0, polarity=0, **kwargs):
+    self.baudrate = baudrate
+
+  def write(self, buf):
+    exchange = self.card.exchange
+    for byte in buf:
+      exchange(byte)
+
+  def read(self, nbytes, write=0x00):
+    exchange = self.card.exchange
+    return bytes(exchange(write) for _ in range(nbytes))
+
+  def readinto(self, buf, write=0x00):
+    exchange = self.card.exchange
+    for i in range(len(buf)):
+      buf[i] = exchange(write)
+
+  def write_readinto(self, write_buf, read_buf):
+    exchange = self.card.exchange
+    for i in range(len(read_buf)):
+      read_buf[i] = exchange(write_buf[i])
+
+
+# returns (spi, cs) for a new emulated card
+def make_card(**kwargs):
+  from machine import Pin
+  card = SDCardEmulator(**kwargs)
+  cs = Pin(5)
+  spi = EmulatedSPI(card, cs)
+  return card, spi, cs
@@ -0,0 +1,58 @@
+# stand-in for the micropython `machine` module when running on a host
+import time
+
+
+class Pin:
+  OUT = 1
+  IN = 0
+
+  def __init__(self, id, mode=None, value=None):
+    self.id = id
+    self._value = value or 0
+
+  def init(self, mode=None, value=None):
+    if value is not None:
+      self._value = value
+
+  def __call__(self, value=None):
+    if value is None:
+      return self._value
+    self._value = value
+
+  def value(self, value=None):
+    return self(value)
+
+  def toggle(self):
+    self._value = 1 - self._value
+
+
+class SPI:
+  MSB = 0
+
+  def __init__(self, id, sck=None, mosi=None, miso=None, baudrate=1000000):
+    self.baudrate = baudrate
+
+  def init(self, baudrate=1000000, phase=0, polarity=0):
+    self.baudrate = baudrate
+
+
+class ADC:
+  def __init__(self, channel):
+    self.channel = channel
+
+  def read_u16(self):
+    return 14000
+
+
+class RTC:
+  def datetime(self, value=None):
+    t = time.localtime()
+    return (t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0)
+
+
+def reset():
+  raise SystemExit("machine.reset()")
+
+
+def unique_id():
+  return b"\x00\x01\x02\x03\x04\x05\x06\x07"
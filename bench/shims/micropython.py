@@ -0,0 +1,17 @@
+# stand-in for the micropython `micropython` module when running on a host
+def const(value):
+  return value
+
+
+# code emitters are not available on the host so the decorated functions
+# run as plain python (or fail and fall back to a pure python version)
+def native(f):
+  return f
+
+
+def viper(f):
+  return f
+
+
+def mem_info(*args):
+  pass
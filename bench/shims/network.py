@@ -0,0 +1,39 @@
+# stand-in for the micropython `network` module when running on a host
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = -3
+STAT_NO_AP_FOUND = -2
+STAT_CONNECT_FAIL = -1
+STAT_GOT_IP = 3
+
+
+class WLAN:
+  def __init__(self, interface=STA_IF):
+    self.interface = interface
+    self._active = False
+
+  def active(self, value=None):
+    if value is None:
+      return self._active
+    self._active = value
+
+  def config(self, **kwargs):
+    pass
+
+  def connect(self, ssid, password=None):
+    pass
+
+  def disconnect(self):
+    pass
+
+  def isconnected(self):
+    return False
+
+  def status(self):
+    return STAT_IDLE
+
+  def ifconfig(self):
+    return ("127.0.0.1", "255.255.255.0", "127.0.0.1", "127.0.0.1")
@@ -0,0 +1,110 @@
+# stand-in for the micropython `uasyncio` module when running on a host.
+# maps the subset phew uses onto asyncio, including micropython's single
+# Stream object that acts as both reader and writer
+import asyncio
+from asyncio import (CancelledError, Event, Lock, TimeoutError, create_task,
+                     gather, sleep, wait_for)
+
+
+def sleep_ms(ms):
+  return asyncio.sleep(ms / 1000)
+
+
+def wait_for_ms(awaitable, timeout):
+  return asyncio.wait_for(awaitable, timeout / 1000)
+
+
+def get_event_loop():
+  try:
+    return asyncio.get_running_loop()
+  except RuntimeError:
+    pass
+  try:
+    return asyncio.get_event_loop_policy().get_event_loop()
+  except RuntimeError:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+def run(coro):
+  return get_event_loop().run_until_complete(coro)
+
+
+# bound to whichever loop first waits on it, like micropython's flag it
+# can be created before any loop is running
+class ThreadSafeFlag:
+  def __init__(self):
+    self._loop = None
+    self._event = None
+    self._pending = False
+
+  def set(self):
+    loop = self._loop
+    if loop is None or loop.is_closed():
+      self._pending = True
+    else:
+      loop.call_soon_threadsafe(self._event.set)
+
+  def clear(self):
+    self._pending = False
+    if self._event:
+      self._event.clear()
+
+  async def wait(self):
+    loop = asyncio.get_running_loop()
+    if self._loop is not loop:
+      self._event = asyncio.Event()
+      self._loop = loop
+    if self._pending:
+      self._pending = False
+      self._event.set()
+    await self._event.wait()
+    self._event.clear()
+
+
+class Stream:
+  def __init__(self, reader, writer):
+    self.reader = reader
+    self.writer = writer
+
+  def get_extra_info(self, name):
+    return self.writer.get_extra_info(name)
+
+  async def read(self, n=-1):
+    return await self.reader.read(n)
+
+  async def readinto(self, buf):
+    data = await self.reader.read(len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+  async def readexactly(self, n):
+    return await self.reader.readexactly(n)
+
+  async def readline(self):
+    return await self.reader.readline()
+
+  def write(self, buf):
+    if isinstance(buf, str):
+      buf = buf.encode()
+    self.writer.write(bytes(buf))
+
+  async def drain(self):
+    await self.writer.drain()
+
+  def close(self):
+    self.writer.close()
+
+  async def wait_closed(self):
+    try:
+      await self.writer.wait_closed()
+    except (ConnectionError, OSError):
+      pass
+
+
+async def start_server(callback, host, port, backlog=5):
+  async def _callback(reader, writer):
+    stream = Stream(reader, writer)
+    await callback(stream, stream)
+  return await asyncio.start_server(_callback, host, port, backlog=backlog)
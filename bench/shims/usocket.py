@@ -0,0 +1,2 @@
+# stand-in for the micropython `usocket` module when running on a host
+from socket import *
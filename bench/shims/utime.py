@@ -0,0 +1,2 @@
+# stand-in for the micropython `utime` module when running on a host
+from time import *
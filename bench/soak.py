@@ -0,0 +1,316 @@
+# soak test for the access point web server. starts main.py's routes in a
+# separate python process listening on localhost, then drives it with a
+# mix of concurrent clients for a while:
+#
+#   - normal clients browsing the pages
+#   - pollers hammering /temperature like the dashboard does
+#   - slowloris clients that trickle a request out a byte at a time
+#   - big form posts, just under and over the body size limit
+#   - uploads that stop short of the Content-Length they declared
+#
+# and reports throughput, tail latency, errors and what the server was
+# left holding once the clients went away (tasks, sockets, heap).
+#
+#   python bench/soak.py [--duration 30] [--clients 8] [--pollers 4]
+#                        [--slowloris 4] [--forms 2] [--stalled 2]
+#                        [--output soak.json]
+import argparse, asyncio, json, os, random, socket, subprocess, sys, tempfile, time
+
+import hostenv
+
+STATS_PATH = "/__soak/stats"
+
+
+# -- server side ------------------------------------------------------------
+
+def serve(port, header_timeout, trace):
+  if trace:
+    import tracemalloc
+    tracemalloc.start()
+  hostenv.install()
+  import run
+
+  workdir = tempfile.mkdtemp(prefix="phew-soak-")
+  app = run.load_app(workdir)
+  from phew import logging, server
+  logging.disable_logging_types(logging.LOG_ALL)
+  server.set_limits(header_timeout=header_timeout, body_timeout=header_timeout)
+
+  def stats(request):
+    result = {
+      "tasks": len(asyncio.all_tasks()),
+      "connections": server._active_connections,
+      "fds": len(os.listdir("/proc/self/fd")) if os.path.isdir("/proc/self/fd") else None,
+      "sd_files": len(os.listdir(app.SD_MOUNT_PATH)),
+    }
+    if trace:
+      import tracemalloc
+      result["heap_current"], result["heap_peak"] = tracemalloc.get_traced_memory()
+      # the baseline request starts the high water mark afresh, so
+      # importing everything doesn't count
+      if "reset" in request.query:
+        tracemalloc.reset_peak()
+    return json.dumps(result), 200, "application/json"
+
+  server.add_route(STATS_PATH, stats)
+  server.run(host="127.0.0.1", port=port)
+
+
+# -- client side ------------------------------------------------------------
+
+class Results:
+  def __init__(self):
+    self.latencies = {}
+    self.statuses = {}
+    self.errors = {}
+    self.bytes = 0
+
+  def add(self, kind, status, latency, size):
+    self.latencies.setdefault(kind, []).append(latency)
+    key = f"{kind} {status}"
+    self.statuses[key] = self.statuses.get(key, 0) + 1
+    self.bytes += size
+
+  def error(self, kind, error):
+    key = f"{kind} {type(error).__name__}"
+    self.errors[key] = self.errors.get(key, 0) + 1
+
+
+def _percentile(samples, p):
+  return samples[min(len(samples) - 1, len(samples) * p // 100)]
+
+
+def _latency_summary(samples):
+  samples = sorted(samples)
+  return {
+    "requests": len(samples),
+    "p50_ms": round(_percentile(samples, 50) * 1000, 2),
+    "p95_ms": round(_percentile(samples, 95) * 1000, 2),
+    "p99_ms": round(_percentile(samples, 99) * 1000, 2),
+    "max_ms": round(samples[-1] * 1000, 2),
+  }
+
+
+# sends one request and reads the response to the end of the connection
+async def fetch(port, raw, timeout=30):
+  start = time.perf_counter()
+  reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+  try:
+    writer.write(raw)
+    await writer.drain()
+    response = await asyncio.wait_for(reader.read(), timeout)
+  finally:
+    writer.close()
+    try:
+      await writer.wait_closed()
+    except OSError:
+      pass
+  status = int(response.split(b" ", 2)[1]) if response.startswith(b"HTTP/") else 0
+  return status, time.perf_counter() - start, response
+
+
+def _get(path):
+  return f"GET {path} HTTP/1.0\r\nHost: 192.168.4.1\r\n\r\n".encode()
+
+
+def _form(size):
+  body = "interval=30&name=" + "x" * max(0, size - 17)
+  return (
+    "POST /savechanges HTTP/1.0\r\nHost: 192.168.4.1\r\n"
+    "Content-Type: application/x-www-form-urlencoded\r\n"
+    f"Content-Length: {len(body)}\r\n\r\n{body}"
+  ).encode()
+
+
+async def _loop(kind, results, deadline, make_request, port, pause=0):
+  while time.monotonic() < deadline:
+    try:
+      status, latency, response = await fetch(port, make_request())
+      results.add(kind, status, latency, len(response))
+    except Exception as e:
+      results.error(kind, e)
+    await asyncio.sleep(pause)
+
+
+async def browser(results, deadline, port, rng):
+  pages = ("/", "/view", "/options", "/upload", "/delete-file", "/metrics")
+  await _loop("browse", results, deadline, lambda: _get(rng.choice(pages)), port, 0.01)
+
+
+async def poller(results, deadline, port):
+  await _loop("temperature", results, deadline, lambda: _get("/temperature"), port)
+
+
+async def form_poster(results, deadline, port, rng):
+  # mostly forms near the 8kB body limit, some over it
+  await _loop("form", results, deadline, lambda: _form(rng.choice((4000, 8000, 8000, 16000))), port, 0.05)
+
+
+# trickles a request out one byte at a time and records how long the
+# server lets the connection hang around
+async def slowloris(results, deadline, port, interval):
+  request = b"GET / HTTP/1.1\r\nHost: 192.168.4.1\r\n" + b"X-Padding: " + b"a" * 4096
+  while time.monotonic() < deadline:
+    start = time.perf_counter()
+    try:
+      reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    except OSError as e:
+      results.error("slowloris", e)
+      await asyncio.sleep(interval)
+      continue
+    status = "held"
+    try:
+      for byte in request:
+        if time.monotonic() > deadline:
+          break
+        writer.write(bytes((byte,)))
+        await writer.drain()
+        try:
+          data = await asyncio.wait_for(reader.read(64), interval)
+        except asyncio.TimeoutError:
+          continue
+        status = data.split(b" ", 2)[1].decode() if data.startswith(b"HTTP/") else "closed"
+        break
+    except OSError:
+      status = "reset"
+    finally:
+      writer.close()
+      try:
+        await writer.wait_closed()
+      except OSError:
+        pass
+    results.add("slowloris", status, time.perf_counter() - start, 0)
+
+
+# starts an upload that declares a longer Content-Length than it sends,
+# then waits for the server to give up on it (with 408)
+async def stalled_upload(results, deadline, port):
+  body = (
+    b"--XX\r\nContent-Disposition: form-data; name=\"file\"; filename=\"stalled.bin\"\r\n"
+    b"Content-Type: application/octet-stream\r\n\r\n" + b"x" * 2048
+  )
+  request = (
+    b"POST /upload HTTP/1.1\r\nHost: 192.168.4.1\r\n"
+    b"Content-Type: multipart/form-data; boundary=XX\r\n"
+    b"Content-Length: " + str(len(body) + 4096).encode() + b"\r\n\r\n" + body
+  )
+  while time.monotonic() < deadline:
+    try:
+      status, latency, response = await fetch(port, request)
+      results.add("stalled", status, latency, len(response))
+    except Exception as e:
+      results.error("stalled", e)
+
+
+async def server_stats(port, reset=False):
+  status, latency, response = await fetch(port, _get(STATS_PATH + ("?reset=1" if reset else "")))
+  return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+async def soak(args, port):
+  rng = random.Random(args.seed)
+  results = Results()
+  baseline = await server_stats(port, reset=True)
+
+  start = time.monotonic()
+  deadline = start + args.duration
+  clients = []
+  clients += [browser(results, deadline, port, random.Random(rng.random())) for _ in range(args.clients)]
+  clients += [poller(results, deadline, port) for _ in range(args.pollers)]
+  clients += [form_poster(results, deadline, port, random.Random(rng.random())) for _ in range(args.forms)]
+  clients += [slowloris(results, deadline, port, args.slowloris_interval) for _ in range(args.slowloris)]
+  clients += [stalled_upload(results, deadline, port) for _ in range(args.stalled)]
+  await asyncio.gather(*clients)
+  elapsed = time.monotonic() - start
+  under_load = await server_stats(port)
+
+  # give idle and half open connections time to be closed by the server
+  await asyncio.sleep(args.settle)
+  settled = await server_stats(port)
+
+  served = sum(len(samples) for kind, samples in results.latencies.items() if kind not in ("slowloris", "stalled"))
+  report = {
+    "duration_s": round(elapsed, 1),
+    "requests": served,
+    "requests_per_s": round(served / elapsed, 1),
+    "bytes_received": results.bytes,
+    "latency": {kind: _latency_summary(samples) for kind, samples in results.latencies.items()},
+    "statuses": results.statuses,
+    "errors": results.errors,
+    "server": {"baseline": baseline, "under_load": under_load, "settled": settled},
+    # anything the server still holds after settling that it didn't
+    # hold before the test is a leak
+    "leaked_tasks": settled["tasks"] - baseline["tasks"],
+    "leaked_fds": settled["fds"] - baseline["fds"] if baseline["fds"] is not None else None,
+    "leaked_connections": settled["connections"] - baseline["connections"],
+  }
+  if "heap_peak" in settled:
+    report["heap_peak"] = settled["heap_peak"]
+    report["heap_growth"] = settled["heap_current"] - baseline["heap_current"]
+  return report
+
+
+def _free_port():
+  with socket.socket() as s:
+    s.bind(("127.0.0.1", 0))
+    return s.getsockname()[1]
+
+
+def _wait_for_server(port, process, timeout=10):
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    if process.poll() is not None:
+      raise RuntimeError("server exited during startup")
+    try:
+      socket.create_connection(("127.0.0.1", port), 0.2).close()
+      return
+    except OSError:
+      time.sleep(0.1)
+  raise RuntimeError("server didn't start listening")
+
+
+def main():
+  parser = argparse.ArgumentParser(description="soak test the access point web server")
+  parser.add_argument("--duration", type=float, default=30)
+  parser.add_argument("--clients", type=int, default=8, help="concurrent page browsers")
+  parser.add_argument("--pollers", type=int, default=4, help="clients polling /temperature")
+  parser.add_argument("--slowloris", type=int, default=4, help="clients trickling requests")
+  parser.add_argument("--slowloris-interval", type=float, default=1.0, help="seconds between bytes")
+  parser.add_argument("--forms", type=int, default=2, help="clients posting large forms")
+  parser.add_argument("--stalled", type=int, default=2, help="clients stalling part way through an upload")
+  parser.add_argument("--header-timeout", type=float, default=10, help="header and body timeout")
+  parser.add_argument("--settle", type=float, default=None, help="seconds to wait after the load stops")
+  parser.add_argument("--no-trace", action="store_true", help="don't track the server heap")
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--output", help="write the report as JSON")
+  parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.serve:
+    serve(args.serve, args.header_timeout, not args.no_trace)
+    return
+
+  if args.settle is None:
+    args.settle = args.header_timeout * 2 + 1
+
+  port = _free_port()
+  command = [sys.executable, os.path.abspath(__file__), "--serve", str(port),
+             "--header-timeout", str(args.header_timeout)]
+  if args.no_trace:
+    command.append("--no-trace")
+  process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+  try:
+    _wait_for_server(port, process)
+    report = asyncio.run(soak(args, port))
+  finally:
+    process.terminate()
+    process.wait()
+
+  print(json.dumps(report, indent=2))
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+  main()
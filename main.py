@@ -3,9 +3,9 @@
 # Torrence Washington
 # July 2025
 
-from phew import server, logging, access_point, dns, connect_to_wifi, is_connected_to_wifi
+from phew import server, logging, metrics, files, access_point, dns, connect_to_wifi, connect_to_wifi_async, is_connected_to_wifi
 from phew.template import render_template
-import json, sdcard, os, _thread, machine, utime, gc, sys, network, socket # type: ignore
+import json, sdcard, sdworker, sdindex, os, machine, utime, uasyncio, gc, sys, network, socket # type: ignore
 from machine import SPI, Pin # type: ignore
 gc.threshold(50000) # setup garbage collection
 
@@ -14,15 +14,36 @@ AP_NAME = "USAP"
 WIFI_FILE = "wifi.json"
 SETTINGS_FILE = "settings.json"
 READING_FILE = "reading.json"
+SAVE_SEQ_FILE = ".save_seq" # next save number, kept on the sd card
 SD_MOUNT_PATH = '/sd'
 global_ip_address = None
+next_save = 1
 SD_SAVES = 1
 SPI_BUS = 0
 SCK_PIN = 2
 MOSI_PIN = 3
 MISO_PIN = 4
 CS_PIN = 5
+UPLOAD_MAX_SIZE = 4 * 1024 * 1024
+SD_CACHE_SECTORS = 16 # 512 bytes of ram each
+SD_MAX_BAUDRATE = 25000000 # fastest spi clock to try for the sd card
+SD_CRC = True # check crcs on sd transfers and retry ones that fail
+SD_INDEX_TTL_MS = 60000 # how long before the sd card's file list is read again
+LISTING_PAGE_SIZE = 50 # files per page on /view and /delete-file
+LISTING_MAX_SIZE = 200 # most files a page can ask for with ?limit=
+LOG_RECORDS = True # compact binary log records, read them back from /logs
 onboard_led = machine.Pin("LED", machine.Pin.OUT)
+logging.enable_records(LOG_RECORDS)
+
+# everything on the sd card goes through this worker, which runs on the
+# second core and owns the spi bus and the /sd mount
+sd_worker = sdworker.SDWorker()
+metrics.add_source(sd_worker.render)
+
+# the files on the card, kept in memory so pages don't list the card
+# every time. changes to the files in /sd go through it to keep it current
+sd_index = sdindex.SDIndex(sd_worker, SD_MOUNT_PATH, ttl_ms=SD_INDEX_TTL_MS)
+metrics.add_source(sd_index.render)
 
 # resets pico, working getting switch to work (pontentially delete or ignore)
 def machine_reset():
@@ -32,7 +53,7 @@ def machine_reset():
 
 # starting page 
 def app_index(request):
-    return render_template(f"{APP_TEMPLATE_PATH}/index.html")
+    return server.TemplateResponse(f"{APP_TEMPLATE_PATH}/index.html")
 
 # configure the wifi connection
 def app_configure(request):
@@ -62,17 +83,19 @@ def app_configure(request):
         """)
     
     # Start connection if not already connected
+    # (as a task rather than a thread: core 1 belongs to the sd worker)
     if not wlan.active() or not wlan.isconnected():
-        def _connect_to_wifi():
+        async def _connect_to_wifi():
             try:
-                connect_to_wifi(request.form["ssid"], request.form["password"])
+                await connect_to_wifi_async(request.form["ssid"], request.form["password"])
             except Exception as e:
                 logging.error(f"Connection failed: {str(e)}")
         
-        _thread.start_new_thread(_connect_to_wifi, ())
+        uasyncio.create_task(_connect_to_wifi())
     
     # Show connection status page with auto-refresh
     current_ip = wlan.ifconfig()[0] if wlan.isconnected() else "Not assigned yet"
+    continue_button = '<button onclick="window.location.href=\'/\'">Continue</button>' if wlan.isconnected() else ''
     return server.Response(f"""
     <!DOCTYPE html>
     <html>
@@ -85,7 +108,7 @@ def app_configure(request):
             <h1>Wifi Configured</h1>
             <p>The Raspberry Pi Pico is connecting to "{ssid}"...</p>
             <p>Go to IP Address: {current_ip}</p>
-            {'<button onclick="window.location.href=\'/\'">Continue</button>' if wlan.isconnected() else ''}
+            {continue_button}
         </body>
     </html>
     """)
@@ -99,7 +122,7 @@ def app_toggle_led(request):
 def app_reset(request):
     """Immediately serves the reset page, then triggers async reset"""
     # Start reset sequence after small delay (allows page to load)
-    _thread.start_new_thread(_delayed_reset, ())
+    uasyncio.create_task(_delayed_reset())
     
     return render_template(
         f"{APP_TEMPLATE_PATH}/reset.html",
@@ -109,14 +132,13 @@ def app_reset(request):
     )
 
 # delay reset to show reset.html
-def _delayed_reset():
-    """Threaded reset with proper timing"""
-    utime.sleep(1.5)  # Critical: Allow page to fully load first
-    _perform_network_reset()
-    sys.exit()
+async def _delayed_reset():
+    """Reset task with proper timing"""
+    await uasyncio.sleep(1.5)  # Critical: Allow page to fully load first
+    await _perform_network_reset()
 
 # disconnect from wifi & reset
-def _perform_network_reset():
+async def _perform_network_reset():
     """Atomic reset operations"""
     try:
         # 1. Delete credentials
@@ -127,11 +149,11 @@ def _perform_network_reset():
         wlan = network.WLAN(network.STA_IF)
         if wlan.isconnected():
             wlan.disconnect()
-            utime.sleep(1)  # Allow graceful disconnect
+            await uasyncio.sleep(1)  # Allow graceful disconnect
             
         # 3. Ensure interface down
         wlan.active(False)
-        utime.sleep(0.5)
+        await uasyncio.sleep(0.5)
         
         # 4. Restart AP
         global ap
@@ -143,64 +165,137 @@ def _perform_network_reset():
 
 # options page 
 def app_change_options(request):
-    return render_template(f"{APP_TEMPLATE_PATH}/options.html")
+    return server.TemplateResponse(f"{APP_TEMPLATE_PATH}/options.html")
 
 # shows changes were saved to a file
-def app_save_changes(request):
+async def app_save_changes(request):
     # Save changes to settings file
-    with open(SETTINGS_FILE, "w") as f:
-        json.dump(request.form, f)
+    await files.write(SETTINGS_FILE, json.dumps(request.form))
     
     # Attempt to transfer to SD card
-    transfer_result = transfer_file_to_sd() if SD_MOUNTED else "SD card not available"
+    transfer_result = await transfer_file_to_sd() if SD_MOUNTED else "SD card not available"
     
     # Get current SD card contents
-    sd_files=list_sd_files()
+    sd_files=await list_sd_files()
     
     return render_template(f"{APP_TEMPLATE_PATH}/save_changes.html",
                          transfer_result=transfer_result,
                          sd_files=sd_files)
 
-# view saves on sd card
-def view_saves(request):
+# reads ?prefix=&offset=&limit= for a page of a file listing, raises
+# ValueError if offset or limit aren't numbers
+def _listing_query(request):
+    offset = int(request.query.get("offset", 0))
+    limit = int(request.query.get("limit", LISTING_PAGE_SIZE))
+    return request.query.get("prefix", ""), max(offset, 0), min(max(limit, 1), LISTING_MAX_SIZE)
+
+# one page of the sorted names that start with prefix, and whether more
+# follow it. the index replaces its listing rather than changing it, so
+# the page can be sent while files are added or removed
+def _listing_page(names, prefix, offset, limit, exclude=None):
+    # names with the prefix sit together, from the first that sorts at
+    # or after it
+    low, high = 0, len(names)
+    while low < high:
+        middle = (low + high) // 2
+        if names[middle] < prefix:
+            low = middle + 1
+        else:
+            high = middle
+    page = []
+    for index in range(low, len(names)):
+        name = names[index]
+        if not name.startswith(prefix):
+            break
+        if name == exclude:
+            continue
+        if offset:
+            offset -= 1
+        elif len(page) == limit:
+            return page, True
+        else:
+            page.append(name)
+    return page, False
+
+# names on the card can be anything an upload was called, so they're
+# escaped in html text and attributes, and % encoded in urls and in the
+# javascript strings (which decodeURIComponent() turns back into the name)
+def _escape_html(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;").replace("'", "&#39;")
+
+# the filter box and previous/next links around a listing page
+def _listing_filter(path, prefix, limit):
+    return f"""
+    <form method="get" action="{path}">
+        <input name="prefix" value="{_escape_html(prefix)}" placeholder="Name starts with">
+        <input type="hidden" name="limit" value="{limit}">
+        <button type="submit">Filter</button>
+    </form>
+    """
+
+def _listing_links(path, prefix, offset, limit, count, more):
+    query = f"&prefix={server.urlencode(prefix)}" if prefix else ""
+    if count:
+        yield f"<p>Files {offset + 1} to {offset + count}</p>"
+    if offset:
+        yield f'<a href="{path}?offset={max(offset - limit, 0)}&limit={limit}{query}">Previous</a> '
+    if more:
+        yield f'<a href="{path}?offset={offset + limit}&limit={limit}{query}">Next</a>'
+
+# view saves on sd card, a page at a time: /view?prefix=&offset=&limit=
+async def view_saves(request):
     try:
-        files = [f for f in os.listdir(SD_MOUNT_PATH) if f != READING_FILE]  # Filter out reading.json
-        file_links = ""
-        for filename in files:
-            file_links += f"""
-            <div style="margin: 10px 0; padding: 10px; border: 1px solid #ccc; display: flex; justify-content: space-between; align-items: center;">
-                <a href="/download/{filename}">{filename}</a>
-                <div>
-                    <button onclick="window.location.href='/apply?file={filename}'" style="margin-right: 5px;">Apply</button>
-                    <button onclick="window.location.href='/rename-file?file={filename}'" style="margin-right: 5px;">Rename</button>
-                    <button onclick="if(confirm('Delete {filename}?')) window.location.href='/delete-file?file={filename}'" style="background-color: #ff4444; color: white;">Delete</button>
-                </div>
-            </div>
-            """
-        if not files:
-            file_links = "<p>No files found.</p>"
+        prefix, offset, limit = _listing_query(request)
+    except ValueError:
+        return "offset and limit must be whole numbers", 400
+    error = None
+    try:
+        files, more = _listing_page(await sd_index.names(), prefix, offset, limit, READING_FILE)  # Filter out reading.json
     except Exception as e:
-        file_links = f"<p>Error: {str(e)}</p>"
-    
-    return server.Response(f"""
+        files, more, error = [], False, e
+
+    # streamed a file at a time rather than built up in ram
+    def page():
+        yield """
     <!DOCTYPE html>
     <html>
     <head>
         <title>SD Card Files</title>
         <style>
-            body {{ font-family: Arial; margin: 20px; }}
-            button {{ margin-left: 10px; }}
+            body { font-family: Arial; margin: 20px; }
+            button { margin-left: 10px; }
         </style>
     </head>
     <body>
         <h1>Files on SD Card</h1>
-        {file_links}
+        """
+        yield _listing_filter("/view", prefix, limit)
+        if error:
+            yield f"<p>Error: {str(error)}</p>"
+        elif not files:
+            yield "<p>No files found.</p>"
+        for filename in files:
+            name, quoted = _escape_html(filename), server.urlencode(filename)
+            yield f"""
+            <div style="margin: 10px 0; padding: 10px; border: 1px solid #ccc; display: flex; justify-content: space-between; align-items: center;">
+                <a href="/download/{quoted}">{name}</a>
+                <div>
+                    <button onclick="window.location.href='/apply?file={quoted}'" style="margin-right: 5px;">Apply</button>
+                    <button onclick="window.location.href='/rename-file?file={quoted}'" style="margin-right: 5px;">Rename</button>
+                    <button onclick="if(confirm('Delete ' + decodeURIComponent('{quoted}') + '?')) window.location.href='/delete-file?file={quoted}'" style="background-color: #ff4444; color: white;">Delete</button>
+                </div>
+            </div>
+            """
+        yield from _listing_links("/view", prefix, offset, limit, len(files), more)
+        yield """
         <br>
         <button onclick="window.location.href='/upload'">Upload File</button>
         <button onclick="window.location.href='/'">Go Home</button>
     </body>
     </html>
-    """)
+    """
+
+    return server.Response(page(), headers={"Content-Type": "text/html"})
 
 # temperature reader on pico, can ignore/delete
 def app_get_temperature(request):
@@ -213,61 +308,86 @@ def app_get_temperature(request):
     return f"{round(temperature, 1)}"
 
 # Add this function to display SD card contents
-def list_sd_files():
+async def list_sd_files():
     try:
-        files = os.listdir(SD_MOUNT_PATH)
+        files = await sd_index.names()
         return "\n".join(files) if files else "No files found on SD card"
     except OSError:
         return "SD card not accessible"
 
+# the number in a save_settings<number>.json name, or 0
+def _save_number(name):
+    if name.startswith("save_settings") and name.endswith(".json"):
+        try:
+            return int(name[13:-5])
+        except ValueError:
+            pass
+    return 0
+
+def _read_save_seq():
+    try:
+        with open(f"{SD_MOUNT_PATH}/{SAVE_SEQ_FILE}") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+# the next save number: the one stored on the card, unless a save with
+# that number or higher is already there (e.g. it was written just before
+# a power cut, before the counter was). run once the sd index is built
+def load_save_seq():
+    highest = max([_save_number(name) for name in sd_index.entries] + [0])
+    return max(sd_worker.call(_read_save_seq), highest + 1)
+
 # Modified transfer_file_to_sd() function
-def transfer_file_to_sd():
+async def transfer_file_to_sd():
     # 1. Check settings file
     try:
-        with open(SETTINGS_FILE, 'r') as f:
-            content = f.read()
-            if not content.strip():
-                return "No file to transfer (empty settings file)!\n" + list_sd_files()
-            
-            try:
-                json.loads(content)  # Validate JSON
-            except ValueError:
-                return "Invalid JSON in settings file!\n" + list_sd_files()
+        content = await files.read(SETTINGS_FILE, "r")
+        if not content.strip():
+            return "No file to transfer (empty settings file)!\n" + await list_sd_files()
+        
+        try:
+            json.loads(content)  # Validate JSON
+        except ValueError:
+            return "Invalid JSON in settings file!\n" + await list_sd_files()
     except OSError:
-        return "No settings file to transfer!\n" + list_sd_files()
+        return "No settings file to transfer!\n" + await list_sd_files()
 
     # 2. Verify SD card
     if not SD_MOUNTED:
-        return "SD card not mounted!\n" + list_sd_files()
+        return "SD card not mounted!\n" + await list_sd_files()
 
-    # 3. Find next available filename
-    save_number = 1
+    # 3. Take the next save number. it's claimed before the await, so
+    # two saves at once can't get the same one
+    global next_save
     while True:
+        save_number = next_save
+        next_save += 1
         new_filename = f"{SD_MOUNT_PATH}/save_settings{save_number}.json"
-        try:
-            with open(new_filename, 'r'):
-                save_number += 1
-        except OSError:
+        if not await sd_index.exists(new_filename): # unless a file was uploaded or renamed to it
             break
 
     # 4. Write to SD card
     try:
-        with open(new_filename, 'w') as f:
-            f.write(content)
-            f.close()
+        await sd_index.write(new_filename, content)
+        # then the counter, if this doesn't happen the save is found at mount.
+        # it's hidden from listings, so it can skip the index
+        await sd_worker.write(f"{SD_MOUNT_PATH}/{SAVE_SEQ_FILE}", str(next_save))
             
         # Return success message with updated file list
+        sd_files = await list_sd_files()
         return (f"Transfer successful! Saved to {new_filename}\n\n"
-                f"Current SD card contents:\n{list_sd_files()}")
+                f"Current SD card contents:\n{sd_files}")
     except OSError as e:
-        return f"Failed to write to SD card: {e}\n\nCurrent contents:\n{list_sd_files()}"
+        sd_files = await list_sd_files()
+        return f"Failed to write to SD card: {e}\n\nCurrent contents:\n{sd_files}"
 
 
     except Exception as e:
         return f"An error occurred: {str(e)}", 500
     
 # apply saved settings to reading.json
-def apply_settings(request):
+async def apply_settings(request):
     filename = request.query.get("file")
     if not filename:
         return "No file specified", 400
@@ -280,13 +400,8 @@ def apply_settings(request):
         source_path = f"{SD_MOUNT_PATH}/{filename}"
         dest_path = f"{SD_MOUNT_PATH}/{READING_FILE}"  # Use global variable
         
-        # Read the source file
-        with open(source_path, "r") as src_file:
-            content = src_file.read()
-        
-        # Write to reading.json
-        with open(dest_path, "w") as dest_file:
-            dest_file.write(content)
+        # Copy the source file to reading.json a block at a time
+        await sd_index.copy(source_path, dest_path)
             
         return server.Response(f"""
         <!DOCTYPE html>
@@ -297,7 +412,7 @@ def apply_settings(request):
         </head>
         <body>
             <h1>Settings Applied Successfully</h1>
-            <p>Content from {filename} has been written to {READING_FILE}</p>
+            <p>Content from {_escape_html(filename)} has been written to {READING_FILE}</p>
             <br>
             <button onclick="window.location.href='/view'">Back to Files</button>
             <button onclick="window.location.href='/'">Go Home</button>
@@ -309,7 +424,7 @@ def apply_settings(request):
         return f"Error applying settings: {str(e)}", 500
 
 # rename saved settings files 
-def rename_file(request):
+async def rename_file(request):
     # grabs names from post request 
     if request.method == "POST":
         old_name = request.form.get("old_name")
@@ -323,8 +438,8 @@ def rename_file(request):
                     new_path = f"{SD_MOUNT_PATH}/{new_name}"
                     
                     # Check if file exists and new name is valid
-                    if old_name in os.listdir(SD_MOUNT_PATH) and new_name.strip():
-                        os.rename(old_path, new_path) # rename file with new name
+                    if await sd_index.exists(old_path) and new_name.strip():
+                        await sd_index.rename(old_path, new_path) # rename file with new name
                         return render_template(f"{APP_TEMPLATE_PATH}/rename_success.html", 
                                             old_name=old_name, 
                                             new_name=new_name)
@@ -335,14 +450,14 @@ def rename_file(request):
     # If GET request or error occurred, show the rename form
     files = []
     try:
-        files = os.listdir(SD_MOUNT_PATH)
+        files = await sd_index.names()
     except Exception as e:
         logging.error(f"Error listing SD card files: {e}")
     
     return render_template(f"{APP_TEMPLATE_PATH}/rename_file.html", files=files)
 
 # delete files from sd 
-def delete_file(request):
+async def delete_file(request):
     if request.method == "POST":
         filename = request.form.get("filename")
         
@@ -353,8 +468,8 @@ def delete_file(request):
                     file_path = f"{SD_MOUNT_PATH}/{filename}"
                     
                     # Check if file exists
-                    if filename in os.listdir(SD_MOUNT_PATH):
-                        os.remove(file_path)
+                    if await sd_index.exists(file_path):
+                        await sd_index.remove(file_path)
                         # Return success response
                         return server.Response(f"""
                         <!DOCTYPE html>
@@ -365,7 +480,7 @@ def delete_file(request):
                         </head>
                         <body>
                             <h1>File Deleted Successfully</h1>
-                            <p>Deleted file: {filename}</p>
+                            <p>Deleted file: {_escape_html(filename)}</p>
                             <br>
                             <button onclick="window.location.href='/delete-file'">Delete Another</button>
                             <button onclick="window.location.href='/view'">View Files</button>
@@ -388,78 +503,164 @@ def delete_file(request):
             """
             return server.Response(error_html, status=500)
     
-    # GET request - show delete form
+    # GET request - show delete form, a page at a time like /view
     try:
-        files = os.listdir(SD_MOUNT_PATH)
-        
-        file_items = ""
+        prefix, offset, limit = _listing_query(request)
+    except ValueError:
+        return "offset and limit must be whole numbers", 400
+    try:
+        files, more = _listing_page(await sd_index.names(), prefix, offset, limit)
+    except Exception as e:
+        logging.error(f"Error listing files: {e}")
+        return server.Response(f"""
+        <!DOCTYPE html>
+        <html>
+        <body>
+            <h1>Error</h1>
+            <p>Could not list files: {str(e)}</p>
+            <button onclick="window.location.href='/'">Go Home</button>
+        </body>
+        </html>
+        """, status=500)
+
+    def page():
+        yield """
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <title>Delete Files</title>
+            <style>
+                body { font-family: Arial; margin: 20px; }
+                button { padding: 5px 10px; margin-left: 5px; }
+            </style>
+        </head>
+        <body>
+            <h1>Delete Files</h1>
+        """
+        yield _listing_filter("/delete-file", prefix, limit)
+        if not files:
+            yield "<p>No files found</p>"
         for filename in files:
-            file_items += f"""
+            name, quoted = _escape_html(filename), server.urlencode(filename)
+            yield f"""
             <div style="margin:10px; padding:10px; border:1px solid #ccc; display:flex; justify-content:space-between;">
-                <span>{filename}</span>
-                <button onclick="if(confirm('Delete {filename}?')) {{ 
+                <span>{name}</span>
+                <button onclick="if(confirm('Delete ' + decodeURIComponent('{quoted}') + '?')) {{ 
                     const form = document.createElement('form');
                     form.method = 'POST';
                     form.action = '/delete-file';
                     const input = document.createElement('input');
                     input.type = 'hidden';
                     input.name = 'filename';
-                    input.value = '{filename}';
+                    input.value = decodeURIComponent('{quoted}');
                     form.appendChild(input);
                     document.body.appendChild(form);
                     form.submit();
                 }}" style="background-color:#ff4444; color:white;">Delete</button>
             </div>
             """
-        
-        html_content = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Delete Files</title>
-            <style>
-                body {{ font-family: Arial; margin: 20px; }}
-                button {{ padding: 5px 10px; margin-left: 5px; }}
-            </style>
-        </head>
-        <body>
-            <h1>Delete Files</h1>
-            {file_items if files else "<p>No files found</p>"}
+        yield from _listing_links("/delete-file", prefix, offset, limit, len(files), more)
+        yield """
             <br>
             <button onclick="window.location.href='/'">Go Home</button>
             <button onclick="window.location.href='/view'">View Files</button>
         </body>
         </html>
         """
-        
-        return server.Response(html_content)
-        
-    except Exception as e:
-        logging.error(f"Error listing files: {e}")
+
+    return server.Response(page(), headers={"Content-Type": "text/html"})
+
+# upload files to the sd card, the file itself is streamed to a temporary
+# file on the card by the server before this is called
+async def upload_file(request):
+    if request.method == "POST":
+        upload = request.file.get("file")
+        if not upload:
+            return "No file uploaded", 400
+
+        # keep only the name, dropping any path the browser sent
+        filename = upload["filename"].replace("\\", "/").split("/")[-1]
+        if not filename or filename.startswith("."):
+            return "Invalid filename", 400
+
+        try:
+            file_path = f"{SD_MOUNT_PATH}/{filename}"
+            if await sd_index.exists(file_path):
+                await sd_index.remove(file_path) # replace existing file
+            await sd_index.rename(upload["path"], file_path)
+            del request.file["file"] # moved, so the server needn't remove it
+        except Exception as e:
+            logging.error(f"Error saving upload: {e}")
+            return f"Error saving file: {str(e)}", 500
+
         return server.Response(f"""
         <!DOCTYPE html>
         <html>
+        <head>
+            <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <title>File Uploaded</title>
+        </head>
         <body>
-            <h1>Error</h1>
-            <p>Could not list files: {str(e)}</p>
+            <h1>File Uploaded Successfully</h1>
+            <p>Saved {_escape_html(filename)} ({upload["size"]} bytes) to the SD card</p>
+            <br>
+            <button onclick="window.location.href='/upload'">Upload Another</button>
+            <button onclick="window.location.href='/view'">View Files</button>
             <button onclick="window.location.href='/'">Go Home</button>
         </body>
         </html>
-        """, status=500)
+        """)
+
+    return server.TemplateResponse(f"{APP_TEMPLATE_PATH}/upload.html")
+
+# logs upload progress at debug level, only when it passes another quarter
+# of the upload so large files don't log (and block on) every block
+_upload_quarter = None
+def upload_progress(filename, received, total):
+    global _upload_quarter
+    quarter = (filename, received * 4 // total if total else 4)
+    if quarter != _upload_quarter:
+        _upload_quarter = quarter
+        logging.debug(f"> uploading {filename}: {received} of {total} bytes")
 
 # downloads file from /view
 @server.route("/download/<filename>")
-def download_file(request, filename):
+async def download_file(request, filename):
+    filename = server.urldecode(filename) # links to it are % encoded
+    # only files in the sd card's directory, checked after decoding so an
+    # encoded ../ can't reach the rest of the filesystem
+    if "/" in filename or "\\" in filename or ".." in filename or filename.startswith("."):
+        return f"Error downloading file: {_escape_html(filename)} not found", 404
+    path = f"{SD_MOUNT_PATH}/{filename}"
     try:
-        with open(f"{SD_MOUNT_PATH}/{filename}", "rb") as f:
-            content = f.read() # gets content from file
-        return server.Response( # downloads file to device
-            content,
-            headers={"Content-Disposition": f"attachment; filename={filename}"} 
-        )
-    except Exception as e:
-        return f"Error downloading file: {str(e)}", 404
+        stat = await sd_index.stat(path)
+    except OSError:
+        return f"Error downloading file: {_escape_html(filename)} not found", 404
+    # streams the file from the sd card rather than reading it into ram,
+    # each block is read by the sd worker
+    return server.FileResponse(
+        path,
+        headers={"Content-Disposition": f"attachment; filename=\"{filename}\""},
+        stat=stat, storage=sd_worker
+    )
+
+# streams log entries, filtered on the device so only what's asked for
+# crosses the link: /logs?level=error,warning&since=<time>&until=<time>
+def view_logs(request):
+    levels = request.query.get("level")
+    mask = logging.level_mask(levels) if levels else logging.LOG_ALL
+    try:
+        since = int(request.query["since"]) if "since" in request.query else None
+        until = int(request.query["until"]) if "until" in request.query else None
+    except ValueError:
+        return "since and until must be whole seconds", 400
+
+    def entries():
+        for record in logging.query(mask, since, until):
+            yield logging.format_record(record)
+
+    return server.Response(entries(), headers={"Content-Type": "text/plain"})
 
 @server.route("/configured-refresh")
 def configured_refresh(request):
@@ -477,15 +678,25 @@ def configured_refresh(request):
 def app_catch_all(request):
         return "Not found.", 404
 
-# Update your SD card initialization to set SD_MOUNTED
-try:
+# sets up the spi bus and mounts the card, run on the sd worker so the
+# bus is only ever used from its core
+def _mount_sd():
     spi = SPI(SPI_BUS, sck=Pin(SCK_PIN), mosi=Pin(MOSI_PIN), miso=Pin(MISO_PIN))
     cs = Pin(CS_PIN)
-    sd = sdcard.SDCard(spi, cs)
+    sd = sdcard.BlockCache(sdcard.SDCard(spi, cs, max_baudrate=SD_MAX_BAUDRATE, crc=SD_CRC), sectors=SD_CACHE_SECTORS)
     os.mount(sd, SD_MOUNT_PATH)
-    print("SD card mounted successfully")
-    print("Initial SD card contents:", list_sd_files())
+    return sd
+
+# Update your SD card initialization to set SD_MOUNTED
+try:
+    sd_worker.start()
+    sd = sd_worker.call(_mount_sd)
+    print(f"SD card mounted successfully ({sd.sd.baudrate} baud)")
+    sd_index.build()
+    print("Initial SD card contents:", sorted(sd_index.entries))
+    next_save = load_save_seq()
     SD_MOUNTED = True
+    server.set_uploads(SD_MOUNT_PATH, max_size=UPLOAD_MAX_SIZE, progress=upload_progress, storage=sd_worker)
 
 
 
@@ -507,12 +718,18 @@ server.add_route("/savechanges", handler = app_save_changes, methods= ["POST", "
 server.add_route("/rename-file", handler=rename_file, methods=["GET", "POST"])
 server.add_route("/delete-file", handler=delete_file, methods=["GET", "POST"])
 server.add_route("/apply", handler=apply_settings, methods=["GET"])
+server.add_route("/upload", handler=upload_file, methods=["GET", "POST"])
+server.add_route("/logs", handler=view_logs, methods=["GET"])
+server.add_route("/metrics", handler=metrics.handler, methods=["GET"])
 server.set_callback(app_catch_all)
 
-# Set to Accesspoint mode
-ap = access_point("USAP")  # Change this to whatever Wi-Fi SSID you wish
-ip = ap.ifconfig()[0]                   # Grab the IP address and store it
-logging.info(f"starting DNS server on {ip}")
-dns.run_catchall(ip)                    # Catch all requests and reroute them
-server.run()                            # Run the server
-logging.info("Webserver Started")
+# only start serving when run as the main program, so the routes above
+# can be imported (e.g. by bench/run.py) without starting the access point
+if __name__ == "__main__":
+    # Set to Accesspoint mode
+    ap = access_point("USAP")  # Change this to whatever Wi-Fi SSID you wish
+    ip = ap.ifconfig()[0]                   # Grab the IP address and store it
+    logging.info(f"starting DNS server on {ip}")
+    dns.run_catchall(ip)                    # Catch all requests and reroute them
+    server.run()                            # Run the server
+    logging.info("Webserver Started")
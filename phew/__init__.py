@@ -91,6 +91,28 @@ def connect_to_wifi(ssid, password, timeout_seconds=30):
     return wlan.ifconfig()[0]
   return None
 
+# connect_to_wifi() for the event loop: waits for the connection with
+# uasyncio.sleep so the web server and dns keep running meanwhile. the
+# wifi chip is driven from the core running the event loop
+async def connect_to_wifi_async(ssid, password, timeout_seconds=30):
+  import network, time, uasyncio # type: ignore
+
+  wlan = network.WLAN(network.STA_IF)
+  wlan.active(True)
+  wlan.connect(ssid, password)
+  start = time.ticks_ms()
+  status = wlan.status()
+  while not wlan.isconnected() and time.ticks_diff(time.ticks_ms(), start) < (timeout_seconds * 1000):
+    new_status = wlan.status()
+    if status != new_status:
+      logging.debug(f"  - status {new_status}")
+      status = new_status
+    await uasyncio.sleep_ms(250)
+
+  if wlan.status() == network.STAT_GOT_IP:
+    return wlan.ifconfig()[0]
+  return None
+
 
 # helper method to put the pico into access point mode
 def access_point(ssid, password = None):
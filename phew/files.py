@@ -0,0 +1,58 @@
+import uasyncio, os # type: ignore
+
+# file helpers for async handlers. they read and write in blocks of one
+# sd card sector and yield to the event loop between blocks, so a large
+# file doesn't stop other clients (or dns replies) being served while it
+# is read or written
+BLOCK_SIZE = 512
+
+
+# returns the whole file, as a str if mode is "r"
+async def read(path, mode="rb"):
+  chunks = []
+  with open(path, "rb") as f:
+    while True:
+      chunk = f.read(BLOCK_SIZE)
+      if not chunk:
+        break
+      chunks.append(chunk)
+      await uasyncio.sleep_ms(0)
+  data = b"".join(chunks)
+  return data.decode("utf-8") if "b" not in mode else data
+
+
+# writes (or with mode "ab" appends) data, a str or bytes, to path
+async def write(path, data, mode="wb"):
+  if type(data) is str:
+    data = data.encode("utf-8")
+  view = memoryview(data)
+  with open(path, mode) as f:
+    for offset in range(0, len(data), BLOCK_SIZE):
+      f.write(view[offset:offset + BLOCK_SIZE])
+      await uasyncio.sleep_ms(0)
+  return len(data)
+
+
+# copies source to destination through a single block sized buffer
+async def copy(source, destination):
+  buffer = bytearray(BLOCK_SIZE)
+  view = memoryview(buffer)
+  copied = 0
+  with open(source, "rb") as infile:
+    with open(destination, "wb") as outfile:
+      while True:
+        length = infile.readinto(buffer)
+        if not length:
+          break
+        outfile.write(view[:length])
+        copied += length
+        await uasyncio.sleep_ms(0)
+  return copied
+
+
+def exists(path):
+  try:
+    os.stat(path)
+    return True
+  except OSError:
+    return False
@@ -1,6 +1,11 @@
-import machine, os, gc # type: ignore
+import machine, os, gc, struct, time # type: ignore
+try:
+  import _thread # type: ignore
+except ImportError:
+  _thread = None
 
 log_file = "log.txt"
+record_file = "log.bin"
 
 LOG_INFO = 0b00001
 LOG_WARNING = 0b00010
@@ -11,11 +16,44 @@ LOG_ALL = LOG_INFO | LOG_WARNING | LOG_ERROR | LOG_DEBUG | LOG_EXCEPTION
 
 _logging_types = LOG_ALL
 
-# the log file will be truncated if it exceeds _log_truncate_at bytes in
-# size. the defaults values are designed to limit the log to at most
-# three blocks on the Pico
-_log_truncate_at = 11 * 1024
-_log_truncate_to =  8 * 1024
+_level_types = {
+  "info": LOG_INFO,
+  "warning": LOG_WARNING,
+  "error": LOG_ERROR,
+  "debug": LOG_DEBUG,
+  "exception": LOG_EXCEPTION
+}
+
+# compact binary records: timestamp, level, status, duration (ms), free
+# memory (kB), route length and message length, followed by the route and
+# message. written to record_file instead of the text log when enabled
+_record_format = "<IBHHHBB"
+_record_header_size = struct.calcsize(_record_format)
+_records = False
+
+# the log file is rotated once it exceeds _log_truncate_at bytes: it is
+# renamed to log.txt.1 (log.txt.1 to log.txt.2 and so on, keeping
+# _log_backup_count old files) and a new log.txt is started. the default
+# values are designed to limit the log to at most three blocks on the Pico
+_log_truncate_at = 6 * 1024
+_log_truncate_to = 0
+_log_backup_count = 1
+
+# size of the log file, tracked here rather than stat'ing it every write
+_log_size = None
+
+# entries waiting to be written to the log file. while the flusher task
+# is running log() only adds to this ring buffer and the flusher writes
+# the entries out in batches, otherwise log() writes straight to the file
+_buffer = [None] * 32
+_buffer_start = 0
+_buffer_count = 0
+_dropped = 0
+_high_water = 24
+_flush_interval_ms = 1000
+_flusher_running = False
+_flush_flag = None
+_lock = _thread.allocate_lock() if _thread else None
 
 def datetime_string():
   dt = machine.RTC().datetime()
@@ -27,12 +65,44 @@ def file_size(file):
   except OSError:
     return None
 
+# truncate_to is kept for compatibility, the log is rotated rather than
+# truncated so the previous file is always kept whole
 def set_truncate_thresholds(truncate_at, truncate_to):
   global _log_truncate_at
   global _log_truncate_to
   _log_truncate_at = truncate_at
   _log_truncate_to = truncate_to
 
+def set_backup_count(count):
+  global _log_backup_count
+  _log_backup_count = count
+
+def set_buffer(entries, high_water = None, interval_ms = None):
+  global _buffer, _buffer_start, _buffer_count, _high_water, _flush_interval_ms
+  flush()
+  _buffer = [None] * entries
+  _buffer_start = 0
+  _buffer_count = 0
+  _high_water = high_water if high_water is not None else entries * 3 // 4
+  if interval_ms is not None:
+    _flush_interval_ms = interval_ms
+
+# number of log entries lost because the buffer was full
+def dropped():
+  return _dropped
+
+# switches between the text log and compact binary records
+def enable_records(enabled = True):
+  global _records, _log_size
+  if enabled == _records:
+    return
+  flush()
+  _records = enabled
+  _log_size = None
+
+def _current_file():
+  return record_file if _records else log_file
+
 def enable_logging_types(types):
   global _logging_types
   _logging_types = _logging_types | types
@@ -80,15 +150,221 @@ def truncate(file, target_size):
   os.rename(file + ".tmp", file)
 
 
-def log(level, text):
+# moves log.txt to log.txt.1, log.txt.1 to log.txt.2 and so on, dropping
+# the oldest file
+def rotate(file):
+  global _log_size
+  for index in range(_log_backup_count, 0, -1):
+    source = file + "." + str(index - 1) if index > 1 else file
+    target = file + "." + str(index)
+    if file_size(source) is None:
+      continue
+    try:
+      os.remove(target)
+    except OSError:
+      pass
+    os.rename(source, target)
+  if not _log_backup_count:
+    try:
+      os.remove(file)
+    except OSError:
+      pass
+  _log_size = 0
+
+def _write(entries):
+  global _log_size
+  file = _current_file()
+  if _log_size is None:
+    _log_size = file_size(file) or 0
+  with open(file, "ab") as logfile:
+    for entry in entries:
+      if type(entry) is str:
+        entry = entry.encode("utf-8") + b"\n"
+      logfile.write(entry)
+      _log_size += len(entry)
+
+  if _log_truncate_at and _log_size > _log_truncate_at:
+    rotate(file)
+
+# takes everything out of the ring buffer
+def _take():
+  global _buffer_start, _buffer_count
+  if _lock:
+    _lock.acquire()
+  entries = []
+  size = len(_buffer)
+  while _buffer_count:
+    entries.append(_buffer[_buffer_start])
+    _buffer[_buffer_start] = None
+    _buffer_start = (_buffer_start + 1) % size
+    _buffer_count -= 1
+  if _lock:
+    _lock.release()
+  return entries
+
+# writes any buffered log entries to the log file
+def flush():
+  entries = _take()
+  if entries:
+    _write(entries)
+
+# background task that writes buffered entries out in batches, either
+# every interval or as soon as the buffer passes its high water mark.
+# server.run() starts this on the event loop
+async def flusher():
+  global _flusher_running, _flush_flag
+  import uasyncio # type: ignore
+  _flush_flag = uasyncio.ThreadSafeFlag()
+  _flusher_running = True
+  try:
+    while True:
+      try:
+        await uasyncio.wait_for_ms(_flush_flag.wait(), _flush_interval_ms)
+      except uasyncio.TimeoutError:
+        pass
+      try:
+        flush()
+      except Exception as e:
+        print("logging: flush failed:", e)
+  finally:
+    _flusher_running = False
+    flush()
+
+def _append(entry):
+  global _buffer_start, _buffer_count, _dropped
+  if _lock:
+    _lock.acquire()
+  size = len(_buffer)
+  if _buffer_count == size:
+    # full, overwrite the oldest entry
+    _buffer_start = (_buffer_start + 1) % size
+    _buffer_count -= 1
+    _dropped += 1
+  _buffer[(_buffer_start + _buffer_count) % size] = entry
+  _buffer_count += 1
+  count = _buffer_count
+  if _lock:
+    _lock.release()
+  if count >= _high_water:
+    _flush_flag.set()
+
+# the first 255 bytes of the utf-8 encoding of text, cut back to the start
+# of a character so the record decodes again
+def _encode(text):
+  data = text.encode("utf-8")
+  if len(data) <= 255:
+    return data
+  end = 255
+  while end and (data[end] & 0xC0) == 0x80:
+    end -= 1
+  return data[:end]
+
+def _clamp(value):
+  return max(0, min(value, 0xFFFF))
+
+def _record(level, text, route, status, duration, memory):
+  route = _encode(route)
+  text = _encode(text)
+  return struct.pack(
+    _record_format, int(time.time()), _level_types.get(level, 0), status,
+    _clamp(duration), _clamp(memory), len(route), len(text)
+  ) + route + text
+
+def log(level, text, route = "", status = 0, duration = 0):
   datetime = datetime_string()
-  log_entry = "{0} [{1:8} /{2:>4}kB] {3}".format(datetime, level, round(gc.mem_free() / 1024), text)
+  memory = round(gc.mem_free() / 1024)
+  log_entry = "{0} [{1:8} /{2:>4}kB] {3}".format(datetime, level, memory, text)
   print(log_entry)
-  with open(log_file, "a") as logfile:
-    logfile.write(log_entry + '\n')
+  if _records:
+    log_entry = _record(level, text, route, status, duration, memory)
+  if _flusher_running and len(_buffer):
+    _append(log_entry)
+  else:
+    flush()
+    _write((log_entry,))
+
+# logs a served request, with its route, status and duration as separate
+# fields in the binary record format
+def access(route, status, duration, text):
+  if _logging_types & LOG_INFO:
+    log("info", text, route, status, duration)
+
+# turns a "level1,level2" string into a logging types mask
+def level_mask(levels):
+  mask = 0
+  for level in levels.split(","):
+    mask |= _level_types.get(level.strip(), 0)
+  return mask
+
+def _parse_line(line):
+  # "YYYY-MM-DD HH:MM:SS [level    /  NNkB] text"
+  try:
+    timestamp = int(time.mktime((
+      int(line[0:4]), int(line[5:7]), int(line[8:10]),
+      int(line[11:13]), int(line[14:16]), int(line[17:19]), 0, 0, -1
+    )))
+    level = line[21:29].strip()
+    close = line.index("]", 29)
+    memory = int(line[31:close - 2])
+  except (ValueError, IndexError):
+    return None
+  return (timestamp, level, "", 0, 0, memory, line[close + 2:])
+
+def _read_lines(file):
+  with open(file, "r") as f:
+    for line in f:
+      record = _parse_line(line.rstrip("\n"))
+      if record:
+        yield record
+
+def _read_records(file):
+  levels = {}
+  for name, bit in _level_types.items():
+    levels[bit] = name
+  with open(file, "rb") as f:
+    while True:
+      header = f.read(_record_header_size)
+      if len(header) < _record_header_size:
+        break
+      timestamp, level, status, duration, memory, route_length, text_length = struct.unpack(_record_format, header)
+      route = f.read(route_length)
+      text = f.read(text_length)
+      # records written before text was cut on a character boundary may
+      # not decode, skip them rather than end the query
+      try:
+        route = route.decode("utf-8")
+        text = text.decode("utf-8")
+      except UnicodeError:
+        continue
+      yield (timestamp, levels.get(level, "?"), route, status, duration, memory, text)
+
+# yields (timestamp, level, route, status, duration, memory, text) for
+# each log entry, oldest first, that matches the level mask and falls in
+# the since/until time range (seconds, as returned by time.time()).
+# entries are read straight from the log files so memory use stays flat
+def query(levels = LOG_ALL, since = None, until = None):
+  flush()
+  file = _current_file()
+  read = _read_records if _records else _read_lines
+  for index in range(_log_backup_count, -1, -1):
+    path = file + "." + str(index) if index else file
+    if file_size(path) is None:
+      continue
+    for record in read(path):
+      if not levels & _level_types.get(record[1], 0):
+        continue
+      if since is not None and record[0] < since:
+        continue
+      if until is not None and record[0] > until:
+        continue
+      yield record
 
-  if _log_truncate_at and file_size(log_file) > _log_truncate_at:
-    truncate(log_file, _log_truncate_to)
+# one line of text for a query() result
+def format_record(record):
+  timestamp, level, route, status, duration, memory, text = record
+  if route:
+    return "{0} {1} {2} {3} {4}ms {5}kB {6}\n".format(timestamp, level, route, status, duration, memory, text)
+  return "{0} {1} {2}kB {3}\n".format(timestamp, level, memory, text)
 
 def info(*items):
   if _logging_types & LOG_INFO:
@@ -0,0 +1,125 @@
+import gc, time # type: ignore
+from array import array
+
+# upper bounds (ms) of the latency histogram buckets, anything slower
+# than the last one lands in a final overflow bucket
+_bucket_bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_enabled = True
+_started = time.ticks_ms()
+
+# stats for every route in registration order, plus requests that
+# didn't match one
+_registry = []
+
+# extra generators of metrics lines, see add_source()
+_sources = []
+
+
+# fixed size counters for one route, allocated once when the route is
+# added so recording a request never allocates
+class RouteStats:
+  def __init__(self, name):
+    self.name = name
+    self.count = 0
+    self.bytes = 0
+    self.client_errors = 0
+    self.server_errors = 0
+    self.max = 0
+    self.buckets = array("I", [0] * (len(_bucket_bounds) + 1))
+
+  def record(self, status, duration, sent):
+    self.count += 1
+    self.bytes += sent
+    if status >= 500:
+      self.server_errors += 1
+    elif status >= 400:
+      self.client_errors += 1
+    if duration > self.max:
+      self.max = duration
+    index = 0
+    for bound in _bucket_bounds:
+      if duration <= bound:
+        break
+      index += 1
+    self.buckets[index] += 1
+
+  # estimated percentile (0-100) in ms: the upper bound of the bucket it
+  # falls in, never more than the slowest request seen
+  def percentile(self, p):
+    if not self.count:
+      return 0
+    target = (self.count * p + 99) // 100
+    seen = 0
+    for index, count in enumerate(self.buckets):
+      seen += count
+      if seen >= target:
+        if index < len(_bucket_bounds):
+          return min(_bucket_bounds[index], self.max)
+        break
+    return self.max
+
+  def reset(self):
+    self.count = 0
+    self.bytes = 0
+    self.client_errors = 0
+    self.server_errors = 0
+    self.max = 0
+    for index in range(len(self.buckets)):
+      self.buckets[index] = 0
+
+
+unmatched = RouteStats("unmatched")
+
+
+def register(name):
+  stats = RouteStats(name)
+  _registry.append(stats)
+  return stats
+
+
+def enable(enabled=True):
+  global _enabled
+  _enabled = enabled
+
+
+def record(stats, status, duration, sent):
+  if _enabled:
+    (stats or unmatched).record(status, duration, sent)
+
+
+# adds a function returning an iterable of extra lines for render()
+def add_source(source):
+  _sources.append(source)
+
+
+def reset():
+  for stats in _registry:
+    stats.reset()
+  unmatched.reset()
+
+
+# yields the metrics as lines of text: one line per route that has seen
+# a request followed by heap and uptime figures
+def render():
+  yield "# route count bytes 4xx 5xx p50_ms p95_ms max_ms\n"
+  for stats in _registry + [unmatched]:
+    if not stats.count:
+      continue
+    yield "{} {} {} {} {} {} {} {}\n".format(
+      stats.name, stats.count, stats.bytes, stats.client_errors,
+      stats.server_errors, stats.percentile(50), stats.percentile(95),
+      stats.max
+    )
+  yield "heap_free {}\n".format(gc.mem_free())
+  yield "heap_alloc {}\n".format(gc.mem_alloc())
+  yield "gc_threshold {}\n".format(gc.threshold())
+  yield "uptime_s {}\n".format(time.ticks_diff(time.ticks_ms(), _started) // 1000)
+  for source in _sources:
+    for line in source():
+      yield line
+
+
+# route handler that serves the metrics as plain text
+def handler(request):
+  return render(), 200, "text/plain"
@@ -0,0 +1,97 @@
+import gc, time # type: ignore
+from array import array
+from . import logging, metrics
+
+# request phases, in the order they happen
+HEADERS = 0
+BODY = 1
+HANDLER = 2
+RENDER = 3
+DRAIN = 4
+PHASES = ("headers", "body", "handler", "render", "drain")
+
+
+# time (us) and memory allocated (bytes) in each phase of one request. a
+# garbage collection during a phase makes its allocation delta negative,
+# those are counted in collections and the phase is recorded as zero
+class Profile:
+  def __init__(self):
+    self.times = array("I", [0] * len(PHASES))
+    self.allocs = array("I", [0] * len(PHASES))
+    self.collections = 0
+    # path pattern of the route that handled the request, None if unmatched
+    self.route = None
+    self._time = time.ticks_us()
+    self._alloc = gc.mem_alloc()
+
+  # ends the current stretch of work, charging it to phase
+  def mark(self, phase):
+    now = time.ticks_us()
+    alloc = gc.mem_alloc()
+    self.times[phase] += time.ticks_diff(now, self._time)
+    if alloc >= self._alloc:
+      self.allocs[phase] += alloc - self._alloc
+    else:
+      self.collections += 1
+    self._time = now
+    self._alloc = alloc
+
+  def __str__(self):
+    return " ".join(
+      "{}={}us/{}B".format(name, self.times[index], self.allocs[index])
+      for index, name in enumerate(PHASES)
+    )
+
+
+# writes each profile to the log
+class LogSink:
+  def report(self, request, response, profile):
+    logging.debug(f"> profile {request.method} {request.path} {profile}")
+
+
+# keeps the profiles of the last `size` requests in memory
+class RingSink:
+  def __init__(self, size=16):
+    self.entries = [None] * size
+    self.next = 0
+
+  def report(self, request, response, profile):
+    self.entries[self.next] = (request.method, request.path, response.status, profile)
+    self.next = (self.next + 1) % len(self.entries)
+
+  # the stored profiles, oldest first
+  def recent(self):
+    size = len(self.entries)
+    for index in range(size):
+      entry = self.entries[(self.next + index) % size]
+      if entry:
+        yield entry
+
+
+# totals each phase per route and adds the averages to /metrics. keyed by
+# the route's pattern rather than the request path, so the number of
+# entries is fixed by the routes however many paths are requested
+class MetricsSink:
+  def __init__(self):
+    self.paths = {}
+    metrics.add_source(self.render)
+
+  def report(self, request, response, profile):
+    path = profile.route or "unmatched"
+    totals = self.paths.get(path)
+    if totals is None:
+      totals = self.paths[path] = [0, array("I", [0] * len(PHASES)), array("I", [0] * len(PHASES))]
+    totals[0] += 1
+    for index in range(len(PHASES)):
+      totals[1][index] += profile.times[index]
+      totals[2][index] += profile.allocs[index]
+
+  def render(self):
+    if not self.paths:
+      return
+    yield "# profile path count " + " ".join(name + "_us/B" for name in PHASES) + "\n"
+    for path, (count, times, allocs) in self.paths.items():
+      yield "profile {} {} {}\n".format(path, count, " ".join(
+        "{}/{}".format(times[index] // count, allocs[index] // count)
+        for index in range(len(PHASES))
+      ))
@@ -1,10 +1,48 @@
 import uasyncio, os, time # type: ignore
-from . import logging
+from . import logging, metrics
+from .profiling import Profile, HEADERS, BODY, HANDLER, RENDER, DRAIN
+from .template import render_template
 
 _routes = []
+# exact path -> {method: route} for routes without parameters
+_static_routes = {}
 catchall_handler = None
+_catchall_is_async = False
 loop = uasyncio.get_event_loop()
 
+# persistent connection settings, see set_keepalive()
+_keepalive_timeout = 10
+_keepalive_max_requests = 100
+_max_connections = 4
+_active_connections = 0
+
+# request parsing limits, see set_limits(). the buffer is allocated once
+# per connection and bounds the length of the request line and of each
+# header line
+_buffer_size = 1024
+_max_header_size = 4096
+_max_body_size = 8192
+_header_timeout = 10
+_body_timeout = 20
+
+# generator bodies are collected into an output buffer of this many bytes
+# (allocated once per connection) and sent a buffer at a time, using
+# chunked transfer encoding for HTTP/1.1 clients. see set_chunk_size()
+_chunk_size = 1024
+
+# file uploads, see set_uploads(). file parts of multipart/form-data bodies
+# are streamed to temporary files in `_upload_dir`, written in blocks that
+# are a multiple of the sd card's 512 byte sector size
+_upload_dir = None
+_max_upload_size = 1024 * 1024
+_upload_progress = None
+_upload_storage = None
+_upload_block_size = 2048
+_upload_count = 0
+
+# receives a profiling.Profile for each request when set, see set_profiler()
+_profiler = None
+
 
 def file_exists(filename):
   try:
@@ -29,6 +67,16 @@ def urldecode(text):
     token_caret = start + 3
   return result
 
+# % encodes everything but letters, digits and -_.~ for use in a url
+def urlencode(text):
+  result = []
+  for byte in text.encode("utf-8"):
+    if (48 <= byte <= 57) or (65 <= byte <= 90) or (97 <= byte <= 122) or byte in b"-_.~":
+      result.append(chr(byte))
+    else:
+      result.append("%{:02X}".format(byte))
+  return "".join(result)
+
 def _parse_query_string(query_string):
   result = {}
   for parameter in query_string.split("&"):
@@ -63,9 +111,9 @@ data: {self.data}"""
 
 
 class Response:
-  def __init__(self, body, status=200, headers={}):
+  def __init__(self, body, status=200, headers=None):
     self.status = status
-    self.headers = headers
+    self.headers = headers if headers is not None else {}
     self.body = body
 
   def add_header(self, name, value):
@@ -88,27 +136,208 @@ content_type_map = {
   "css": "text/css",
   "js": "text/javascript",
   "csv": "text/csv",
+  "txt": "text/plain",
 }
 
+# buffer shared by every file response being streamed, it's safe to share
+# because each chunk is copied into the stream's output buffer by
+# writer.write() before we next yield to the event loop
+_file_buffer = bytearray(1024)
+_file_buffer_view = memoryview(_file_buffer)
 
+_weekdays = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_months = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+# formats a timestamp (as returned by os.stat) as an http date
+def http_date(timestamp):
+  t = time.gmtime(timestamp)
+  return f"{_weekdays[t[6]]}, {t[2]:02d} {_months[t[1] - 1]} {t[0]} {t[3]:02d}:{t[4]:02d}:{t[5]:02d} GMT"
+
+
+# a file streamed from flash or the sd card. `stat` can pass in the file's
+# os.stat() result if the handler already has it, and `storage` is an
+# object with an open(path, mode) method (such as sdworker.SDWorker) to
+# read the file through instead of the built in open(). its file's
+# readinto(), seek() and close() may be async
 class FileResponse(Response):
-  def __init__(self, file, status=200, headers={}):
+  def __init__(self, file, status=200, headers=None, stat=None, storage=None):
     self.status = 404
-    self.headers = headers
+    self.headers = headers if headers is not None else {}
+    self.body = ""
     self.file = file
+    self.storage = storage
+    self.size = 0
+    # the part of the file that will be sent
+    self.offset = 0
+    self.length = 0
 
     try:
-      if (os.stat(self.file)[0] & 0x4000) == 0:
-        self.status = 200
+      if stat is None:
+        stat = os.stat(self.file)
+      if (stat[0] & 0x4000) == 0:
+        self.status = status
+        self.size = stat[6]
+        self.length = self.size
 
         # auto set content type
-        extension = self.file.split(".")[-1].lower()
-        if extension in content_type_map:
-          headers["Content-Type"] = content_type_map[extension]
+        if "Content-Type" not in self.headers:
+          extension = self.file.split(".")[-1].lower()
+          self.headers["Content-Type"] = content_type_map.get(extension, "application/octet-stream")
 
-        headers["Content-Length"] = os.stat(self.file)[6]
+        # validators so clients can resume and revalidate downloads
+        self.headers["Accept-Ranges"] = "bytes"
+        self.headers["ETag"] = f'"{stat[8]:x}-{self.size:x}"'
+        self.headers["Last-Modified"] = http_date(stat[8])
+        if "Cache-Control" not in self.headers:
+          self.headers["Cache-Control"] = "no-cache"
     except OSError:
-      return False
+      pass
+
+    self.headers["Content-Length"] = self.length
+
+  # switches to a gzip compressed copy of the file (the same name with
+  # ".gz" added, see tools/precompress.py) if there is one and the client
+  # accepts gzip. copies older than the file itself are ignored. returns
+  # the response to send
+  def negotiate_encoding(self, accept_encoding):
+    if self.status != 200 or "Content-Encoding" in self.headers or self.storage:
+      return self
+    try:
+      stat = os.stat(self.file + ".gz")
+      if stat[8] < os.stat(self.file)[8]:
+        return self
+    except OSError:
+      return self
+
+    # the response depends on the request's Accept-Encoding either way
+    self.headers["Vary"] = "Accept-Encoding"
+    if not _accepts_gzip(accept_encoding):
+      return self
+
+    self.file += ".gz"
+    self.size = self.length = stat[6]
+    self.headers["Content-Encoding"] = "gzip"
+    self.headers["ETag"] = f'"{stat[8]:x}-{self.size:x}-gz"'
+    self.headers["Last-Modified"] = http_date(stat[8])
+    self.headers["Content-Length"] = self.length
+    return self
+
+  # narrows the response to the single byte range requested in a `Range`
+  # header. multiple ranges, other units or a stale `If-Range` validator
+  # are ignored and the whole file is sent
+  def set_range(self, range_header, if_range=None):
+    if self.status != 200:
+      return
+    if if_range and if_range not in (self.headers["ETag"], self.headers["Last-Modified"]):
+      return
+
+    try:
+      unit, spec = range_header.split("=", 1)
+      if unit.strip() != "bytes" or "," in spec:
+        return
+      start, end = spec.strip().split("-", 1)
+      # an invalid range is ignored and the whole file sent, only a valid
+      # one that starts past the end of the file gets 416
+      if not (start or end) or (start and not start.isdigit()) or (end and not end.isdigit()):
+        return
+      if start:
+        start = int(start)
+        if end and int(end) < start:
+          return
+        end = int(end) if end else self.size - 1
+      else:
+        # suffix range, the last n bytes of the file
+        start = max(self.size - int(end), 0)
+        end = self.size - 1 if int(end) else -1
+    except ValueError:
+      return
+
+    end = min(end, self.size - 1)
+    if start > end:
+      self.status = 416
+      self.offset = self.length = 0
+      self.headers["Content-Range"] = f"bytes */{self.size}"
+    else:
+      self.status = 206
+      self.offset = start
+      self.length = end - start + 1
+      self.headers["Content-Range"] = f"bytes {start}-{end}/{self.size}"
+    self.headers["Content-Length"] = self.length
+
+
+# a page rendered from a template. the template is only read once the
+# body is sent, so a client revalidating its cached copy can be answered
+# with 304 Not Modified using just the file's metadata
+class TemplateResponse(Response):
+  def __init__(self, template, status=200, headers=None, **kwargs):
+    self.status = status
+    self.headers = headers if headers is not None else {}
+    self.template = template
+    self.kwargs = kwargs
+    self.body = render_template(template, **kwargs)
+
+    if "Content-Type" not in self.headers:
+      self.headers["Content-Type"] = "text/html"
+
+    try:
+      stat = os.stat(template)
+    except OSError:
+      self.status = 404
+      self.body = ""
+      return
+
+    # pages rendered with different arguments need different tags
+    etag = f"{stat[8]:x}-{stat[6]:x}"
+    if kwargs:
+      etag += f"-{hash(repr(sorted(kwargs.items()))) & 0xffffffff:x}"
+    self.headers["ETag"] = f'"{etag}"'
+    if "Cache-Control" not in self.headers:
+      self.headers["Cache-Control"] = "no-cache"
+
+  # templates rendered without arguments can be served from a gzip
+  # compressed copy (see tools/precompress.py, which only compresses
+  # templates with no {{ }} tags) instead of being rendered. returns the
+  # response to send
+  def negotiate_encoding(self, accept_encoding):
+    if self.status != 200 or self.kwargs:
+      return self
+    response = FileResponse(self.template, self.status, dict(self.headers))
+    response = response.negotiate_encoding(accept_encoding)
+    if "Content-Encoding" in response.headers:
+      return response
+    if "Vary" in response.headers:
+      self.headers["Vary"] = "Accept-Encoding"
+    return self
+
+
+# True if handler is an `async def` function, so calling it returns a
+# coroutine to await rather than the response. on micropython these are
+# generator functions (as is a plain function that yields), on cpython
+# the code object is flagged as a coroutine
+def _is_async(handler):
+  if type(handler).__name__ == "generator":
+    return True
+  code = getattr(getattr(handler, "__func__", handler), "__code__", None)
+  return bool(code and code.co_flags & 0x80)
+
+
+# True if an Accept-Encoding header allows gzip
+def _accepts_gzip(accept_encoding):
+  for coding in accept_encoding.lower().split(","):
+    parts = coding.split(";")
+    if parts[0].strip() not in ("gzip", "x-gzip"):
+      continue
+    # "gzip;q=0" means anything but gzip
+    for parameter in parts[1:]:
+      name, value = (parameter.split("=", 1) + [""])[:2]
+      if name.strip() == "q":
+        try:
+          return float(value) > 0
+        except ValueError:
+          return False
+    return True
+  return False
 
 
 class Route:
@@ -117,6 +346,12 @@ class Route:
     self.methods = methods
     self.handler = handler
     self.path_parts = path.split("/")
+    # names of the <parameters> in the order they appear in the path
+    self.parameter_names = [
+      part[1:-1] for part in self.path_parts if part.startswith("<")
+    ]
+    self.stats = metrics.register(path)
+    self.is_async = _is_async(handler)
 
   # returns True if the supplied request matches this route
   def matches(self, request):
@@ -130,13 +365,15 @@ class Route:
         return False
     return True
 
-  # call the route handler passing any named parameters in the path
-  def call_handler(self, request):
-    parameters = {}
-    for part, compare in zip(self.path_parts, request.path.split("/")):
-      if part.startswith("<"):
-        name = part[1:-1]
-        parameters[name] = compare
+  # call the route handler passing any named parameters in the path, if
+  # the parameter values weren't captured while matching then extract
+  # them from the request path
+  def call_handler(self, request, parameters=None):
+    if parameters is None:
+      parameters = {}
+      for part, compare in zip(self.path_parts, request.path.split("/")):
+        if part.startswith("<"):
+          parameters[part[1:-1]] = compare
 
     return self.handler(request, **parameters)
         
@@ -150,57 +387,414 @@ methods: {self.methods}
     return f"<Route object {self.path} ({', '.join(self.methods)})>"
 
 
+# a node in the routing trie, one level per path segment. literal
+# segments live in `children` while any <parameter> segment shares the
+# single `parameter` child. `methods` maps http method to the route that
+# ends at this node
+class _RouteNode:
+  def __init__(self):
+    self.children = {}
+    self.parameter = None
+    self.methods = {}
+
+
+_route_tree = _RouteNode()
+
+
+# raised while reading a request that can't be served, the connection is
+# answered with `status` and closed
+class _RequestError(Exception):
+  def __init__(self, status):
+    super().__init__(status)
+    self.status = status
+
+
+# writes a streamed response body through a buffer so that lots of small
+# generator chunks go out as a few full segments. with chunked set each
+# buffer is framed as an HTTP/1.1 chunk and finish() writes the last chunk,
+# otherwise the body is sent as is and ends when the connection closes
+class _BodyWriter:
+  def __init__(self, writer, size):
+    self.writer = writer
+    self.size = size
+    self.buffer = None
+    self.view = None
+    self.length = 0
+    self.chunked = False
+    self.sent = 0
+    # set once the status line of the current response has been written
+    self.responding = False
+
+  def start(self, chunked):
+    if self.buffer is None:
+      self.buffer = bytearray(self.size)
+      self.view = memoryview(self.buffer)
+    self.length = 0
+    self.chunked = chunked
+    self.sent = 0
+
+  async def write(self, data):
+    if type(data) is str:
+      data = data.encode("utf-8")
+    view = memoryview(data)
+    offset = 0
+    length = len(data)
+    while offset < length:
+      if not self.length and length - offset >= self.size:
+        # whole buffers' worth with nothing waiting, sent without copying
+        end = offset + (length - offset) // self.size * self.size
+        await self._send(view[offset:end])
+        offset = end
+        continue
+      # copy what fits, sending the buffer once it's full
+      count = min(self.size - self.length, length - offset)
+      self.buffer[self.length:self.length + count] = view[offset:offset + count]
+      self.length += count
+      offset += count
+      if self.length == self.size:
+        await self.flush()
+
+  async def flush(self):
+    if self.length:
+      await self._send(self.view[:self.length])
+      self.length = 0
+
+  async def finish(self):
+    await self.flush()
+    if self.chunked:
+      self.writer.write(b"0\r\n\r\n")
+      await self.writer.drain()
+
+  async def _send(self, data):
+    if not len(data):
+      return
+    if self.chunked:
+      self.writer.write("{:x}\r\n".format(len(data)).encode("ascii"))
+    self.writer.write(data)
+    if self.chunked:
+      self.writer.write(b"\r\n")
+    await self.writer.drain()
+    self.sent += len(data)
+
+
+# reads requests from a stream through a fixed size buffer so that no
+# single line can grow beyond the buffer and the memory used per
+# connection stays constant
+class _RequestReader:
+  def __init__(self, stream, size):
+    self.stream = stream
+    self.buffer = bytearray(size)
+    self.view = memoryview(self.buffer)
+    self.start = 0
+    self.end = 0
+    # total bytes received from the stream, for tracking body lengths
+    self.received = 0
+    # if set, the seconds to wait for each read before timing out
+    self.timeout = None
+
+  # returns the number of bytes consumed from the stream so far
+  def tell(self):
+    return self.received - (self.end - self.start)
+
+  # reads from the stream into `buffer`, giving up after `timeout` seconds
+  # without any data if it's set
+  async def _read(self, buffer):
+    if self.timeout:
+      length = await uasyncio.wait_for(self.stream.readinto(buffer), self.timeout)
+    else:
+      length = await self.stream.readinto(buffer)
+    self.received += length or 0
+    return length
+
+  # moves unconsumed bytes to the front of the buffer and reads more from
+  # the stream after them, returns False at the end of the stream
+  async def _fill(self):
+    if self.start:
+      pending = self.end - self.start
+      if pending:
+        self.buffer[:pending] = self.buffer[self.start:self.end]
+      self.start = 0
+      self.end = pending
+    length = await self._read(self.view[self.end:])
+    if not length:
+      return False
+    self.end += length
+    return True
+
+  # returns the next line including its line break (or whatever is left at
+  # the end of the stream). lines longer than the buffer raise a
+  # _RequestError with `status`
+  async def readline(self, status=400):
+    while True:
+      index = bytes(self.view[self.start:self.end]).find(b"\n")
+      if index != -1:
+        line = bytes(self.view[self.start:self.start + index + 1])
+        self.start += index + 1
+        return line
+      if self.end - self.start == len(self.buffer):
+        raise _RequestError(status)
+      if not await self._fill():
+        line = bytes(self.view[self.start:self.end])
+        self.start = self.end = 0
+        return line
+
+  # copies up to len(buffer) bytes into `buffer`, returns the number copied
+  # or 0 at the end of the stream
+  async def readinto(self, buffer):
+    if self.start == self.end:
+      self.start = self.end = 0
+      return await self._read(buffer)
+    length = min(len(buffer), self.end - self.start)
+    buffer[:length] = self.view[self.start:self.start + length]
+    self.start += length
+    return length
+
+  async def readexactly(self, length):
+    result = bytearray(length)
+    view = memoryview(result)
+    offset = 0
+    while offset < length:
+      count = await self.readinto(view[offset:])
+      if not count:
+        raise EOFError()
+      offset += count
+    return bytes(result)
+
+  # passes everything up to `delimiter` to `sink` (as memoryviews that are
+  # only valid for the duration of the call) and consumes the delimiter
+  async def readuntil(self, delimiter, sink):
+    while True:
+      data = bytes(self.view[self.start:self.end])
+      index = data.find(delimiter)
+      if index != -1:
+        if index:
+          await _complete(sink(self.view[self.start:self.start + index]))
+        self.start += index + len(delimiter)
+        return
+      # hold back enough bytes to spot a delimiter split across reads
+      count = len(data) - min(len(delimiter) - 1, len(data))
+      if count:
+        await _complete(sink(self.view[self.start:self.start + count]))
+        self.start += count
+      if not await self._fill():
+        raise EOFError()
+
+  # reads and throws away `length` bytes
+  async def discard(self, length):
+    while length > 0:
+      count = await self.readinto(self.view[:min(length, len(self.buffer))])
+      if not count:
+        raise EOFError()
+      length -= count
+
+
 # parses the headers for a http request (or the headers attached to
-# each field in a multipart/form-data)
-async def _parse_headers(reader):
+# each field in a multipart/form-data), raising 431 if they add up to
+# more than `limit` bytes
+async def _parse_headers(reader, limit):
   headers = {}
   while True:
-    header_line = await reader.readline()
-    if header_line == b"\r\n": # crlf denotes body start
+    header_line = await reader.readline(431)
+    if header_line in (b"\r\n", b"\n"): # crlf denotes body start
       break
-    name, value = header_line.decode().strip().split(": ", 1)
-    headers[name.lower()] = value
+    if not header_line:
+      raise _RequestError(400)
+    limit -= len(header_line)
+    if limit < 0:
+      raise _RequestError(431)
+    try:
+      name, value = header_line.decode().split(":", 1)
+    except ValueError:
+      raise _RequestError(400)
+    headers[name.strip().lower()] = value.strip()
   return headers
 
 
-# returns the route matching the supplied path or None
-def _match_route(request):
-  for route in _routes:
-    if route.matches(request):
+# walks the routing trie from `node` trying literal segments before
+# parameters. values for parameter segments are appended to `captured`
+# on the way down and removed again when a branch doesn't match
+def _match_node(node, parts, index, method, captured):
+  if index == len(parts):
+    return node.methods.get(method)
+
+  child = node.children.get(parts[index])
+  if child:
+    route = _match_node(child, parts, index + 1, method, captured)
+    if route:
       return route
+
+  if node.parameter:
+    captured.append(parts[index])
+    route = _match_node(node.parameter, parts, index + 1, method, captured)
+    if route:
+      return route
+    captured.pop()
+
   return None
 
 
-# if the content type is multipart/form-data then parse the fields
-async def _parse_form_data(reader, headers):
-  boundary = headers["content-type"].split("boundary=")[1]
-  # discard first boundary line
-  dummy = await reader.readline()
+# returns the route matching the supplied request and the values of any
+# path parameters, or (None, None)
+def _match_route(request):
+  # fast path for routes without parameters
+  methods = _static_routes.get(request.path)
+  if methods:
+    route = methods.get(request.method)
+    if route:
+      return route, {}
 
-  form = {}
-  while True:
-    # get the field name
-    field_headers = await _parse_headers(reader)
-    if len(field_headers) == 0:
-      break
-    name = field_headers["content-disposition"].split("name=\"")[1][:-1]
-    # get the field value
-    value = ""
-    while True:
-      line = await reader.readline()
-      line = line.decode().strip()
-      # if we hit a boundary then save the value and move to next field
-      if line == "--" + boundary:
-        form[name] = value
-        break
-      # if we hit end of form data boundary then save value and return
-      if line == "--" + boundary + "--":
-        form[name] = value
-        return form
-      value += line
+  captured = []
+  route = _match_node(_route_tree, request.path.split("/"), 0, request.method, captured)
+  if not route:
+    return None, None
+  return route, dict(zip(route.parameter_names, captured))
+
+
+# returns the value of a parameter (e.g. `name`) in a header like
+# content-disposition, or None if it isn't present
+def _header_parameter(header, parameter):
+  for part in header.split(";"):
+    part = part.strip()
+    if part.startswith(parameter + "="):
+      return part[len(parameter) + 1:].strip('"')
   return None
 
 
+# collects the value of a form field, limited to `limit` bytes
+class _FieldValue:
+  def __init__(self, limit):
+    self.parts = []
+    self.limit = limit
+
+  def write(self, data):
+    self.limit -= len(data)
+    if self.limit < 0:
+      raise _RequestError(413)
+    self.parts.append(bytes(data))
+
+  def value(self):
+    return b"".join(self.parts).decode()
+
+
+# streams an uploaded file to disk through a fixed size buffer so that
+# every write is a whole number of sd card sectors (except the last)
+class _UploadFile:
+  def __init__(self, path, filename, total):
+    self.path = path
+    self.filename = filename
+    self.total = total
+    self.size = 0
+    self.buffer = bytearray(_upload_block_size)
+    self.view = memoryview(self.buffer)
+    self.used = 0
+    self.file = _upload_storage.open(path, "wb") if _upload_storage else open(path, "wb")
+
+  async def write(self, data):
+    self.size += len(data)
+    if self.size > _max_upload_size:
+      raise _RequestError(413)
+    while data:
+      count = min(len(data), len(self.buffer) - self.used)
+      self.buffer[self.used:self.used + count] = data[:count]
+      self.used += count
+      data = data[count:]
+      if self.used == len(self.buffer):
+        await _complete(self.file.write(self.buffer))
+        self.used = 0
+        if _upload_progress:
+          _upload_progress(self.filename, self.size, self.total)
+
+  async def close(self):
+    if self.file:
+      if self.used:
+        await _complete(self.file.write(self.view[:self.used]))
+        self.used = 0
+      await _complete(self.file.close())
+      self.file = None
+
+
+# awaits the result of a storage method if it's async (see set_uploads()
+# and FileResponse), otherwise returns it as it is
+async def _complete(result):
+  if type(result).__name__ in ("generator", "coroutine"):
+    return await result
+  return result
+
+
+async def _remove_upload(path):
+  try:
+    if _upload_storage:
+      if await _complete(_upload_storage.exists(path)):
+        await _complete(_upload_storage.remove(path))
+    elif file_exists(path):
+      os.remove(path)
+  except OSError:
+    pass
+
+
+# removes any temporary upload files that are still around
+async def _remove_uploads(request):
+  for upload in request.file.values():
+    await _remove_upload(upload["path"])
+
+
+# if the content type is multipart/form-data then parse the fields,
+# streaming any files to the upload directory as they arrive
+async def _parse_form_data(reader, request, content_length):
+  global _upload_count
+  boundary = _header_parameter(request.headers["content-type"], "boundary")
+  if not boundary:
+    raise _RequestError(400)
+  delimiter = b"\r\n--" + boundary.encode()
+  body_start = reader.tell()
+  fields_limit = _max_body_size
+
+  # discard everything up to the end of the first boundary line
+  await reader.readuntil(delimiter[2:], lambda data: None)
+  last = (await reader.readline(400)).startswith(b"--")
+
+  upload = None
+  try:
+    while not last:
+      field_headers = await _parse_headers(reader, _max_header_size)
+      disposition = field_headers.get("content-disposition", "")
+      name = _header_parameter(disposition, "name")
+      filename = _header_parameter(disposition, "filename")
+
+      if filename is not None and _upload_dir:
+        _upload_count += 1
+        upload = _UploadFile(f"{_upload_dir}/.upload{_upload_count}.tmp", filename, content_length)
+        await reader.readuntil(delimiter, upload.write)
+        await upload.close()
+        request.file[name] = {
+          "filename": filename,
+          "path": upload.path,
+          "size": upload.size,
+          "content_type": field_headers.get("content-type", "application/octet-stream")
+        }
+        upload = None
+      else:
+        value = _FieldValue(fields_limit)
+        await reader.readuntil(delimiter, value.write)
+        fields_limit = value.limit
+        request.form[name] = value.value()
+
+      # the boundary is followed by "--" on the last part
+      last = (await reader.readline(400)).startswith(b"--")
+  except:
+    if upload:
+      await upload.close()
+      await _remove_upload(upload.path)
+    await _remove_uploads(request)
+    raise
+
+  # skip any epilogue after the closing boundary
+  remaining = content_length - (reader.tell() - body_start)
+  if remaining < 0:
+    raise _RequestError(400)
+  await reader.discard(remaining)
+
+
 # if the content type is application/json then parse the body
 async def _parse_json_body(reader, headers):
   import json
@@ -209,6 +803,51 @@ async def _parse_json_body(reader, headers):
   return json.loads(body.decode())
 
 
+# reads the request body into request.form or request.data depending on
+# its content type, any other body is discarded so the next request on
+# the connection starts in the right place
+async def _parse_body(reader, request):
+  try:
+    content_length = int(request.headers["content-length"])
+  except ValueError:
+    raise _RequestError(400)
+
+  content_type = request.headers.get("content-type", "")
+  if content_type.startswith("multipart/form-data"):
+    if content_length > _max_body_size + (_max_upload_size if _upload_dir else 0):
+      raise _RequestError(413)
+    # uploads can take a while so time out if the client stalls rather
+    # than limiting how long the whole body can take
+    reader.timeout = _body_timeout
+    try:
+      await _parse_form_data(reader, request, content_length)
+    finally:
+      reader.timeout = None
+    return
+
+  if content_length > _max_body_size:
+    raise _RequestError(413)
+  await uasyncio.wait_for(_read_body(reader, request, content_type, content_length), _body_timeout)
+
+
+# reads a body that is held in memory, or discarded if it isn't one we parse
+async def _read_body(reader, request, content_type, content_length):
+  if content_type.startswith("application/json"):
+    request.data = await _parse_json_body(reader, request.headers)
+  elif content_type.startswith("application/x-www-form-urlencoded"):
+    form_data = await reader.readexactly(content_length)
+    request.form = _parse_query_string(form_data.decode())
+  else:
+    await reader.discard(content_length)
+
+
+# writes a bodiless error response, used when a request can't be parsed
+async def _send_error(writer, status):
+  status_message = status_message_map.get(status, "Unknown")
+  writer.write(f"HTTP/1.1 {status} {status_message}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode("ascii"))
+  await writer.drain()
+
+
 status_message_map = {
   200: "OK", 201: "Created", 202: "Accepted", 
   203: "Non-Authoritative Information", 204: "No Content",
@@ -219,41 +858,109 @@ status_message_map = {
   400: "Bad Request", 401: "Unauthorized", 403: "Forbidden",
   404: "Not Found", 405: "Method Not Allowed", 406: "Not Acceptable",
   408: "Request Timeout", 409: "Conflict", 410: "Gone",
-  414: "URI Too Long", 415: "Unsupported Media Type", 
-  416: "Range Not Satisfiable", 418: "I'm a teapot",
+  413: "Payload Too Large", 414: "URI Too Long",
+  415: "Unsupported Media Type", 416: "Range Not Satisfiable",
+  418: "I'm a teapot", 431: "Request Header Fields Too Large",
   500: "Internal Server Error", 501: "Not Implemented"
 }
 
 
-# handle an incoming request to the web server
-async def _handle_request(reader, writer):
+# headers that are repeated on a 304 Not Modified response
+_not_modified_headers = ("ETag", "Last-Modified", "Cache-Control", "Vary")
+
+
+# returns True if the client's cached copy (identified by the request's
+# If-None-Match or If-Modified-Since header) is still current
+def _not_modified(request, response):
+  if "if-none-match" in request.headers:
+    etag = response.headers.get("ETag")
+    if not etag:
+      return False
+    for tag in request.headers["if-none-match"].split(","):
+      tag = tag.strip()
+      if tag.startswith("W/"):
+        tag = tag[2:]
+      if tag == etag or tag == "*":
+        return True
+    return False
+
+  if "if-modified-since" in request.headers:
+    return request.headers["if-modified-since"] == response.headers.get("Last-Modified")
+
+  return False
+
+
+# handle a single request on a connection, returns True if the connection
+# can be kept open for another request
+async def _serve_request(reader, writer, output, request_line, keep_alive):
   response = None
 
   request_start_time = time.ticks_ms()
+  profile = Profile() if _profiler else None
+  output.responding = False
 
-  request_line = await reader.readline()
   try:
     method, uri, protocol = request_line.decode().split()
-  except Exception as e:
-    logging.error(e)
-    return
+  except Exception:
+    raise _RequestError(400)
 
   request = Request(method, uri, protocol)
-  request.headers = await _parse_headers(reader)
-  if "content-length" in request.headers and "content-type" in request.headers:
-    if request.headers["content-type"].startswith("multipart/form-data"):
-      request.form = await _parse_form_data(reader, request.headers)
-    if request.headers["content-type"].startswith("application/json"):
-      request.data = await _parse_json_body(reader, request.headers)
-    if request.headers["content-type"].startswith("application/x-www-form-urlencoded"):
-      form_data = await reader.read(int(request.headers["content-length"]))
-      request.form = _parse_query_string(form_data.decode()) 
-
-  route = _match_route(request)
-  if route:
-    response = route.call_handler(request)
-  elif catchall_handler:
-    response = catchall_handler(request)
+  try:
+    request.headers = await uasyncio.wait_for(
+      _parse_headers(reader, _max_header_size), _header_timeout)
+    if profile:
+      profile.mark(HEADERS)
+    if "content-length" in request.headers:
+      await _parse_body(reader, request)
+      if profile:
+        profile.mark(BODY)
+  except uasyncio.TimeoutError:
+    raise _RequestError(408)
+  except EOFError:
+    raise _RequestError(400)
+
+  route, parameters = _match_route(request)
+  if profile and route:
+    profile.route = route.path
+  try:
+    if route:
+      response = route.call_handler(request, parameters)
+      if route.is_async:
+        response = await response
+    elif catchall_handler:
+      response = catchall_handler(request)
+      if _catchall_is_async:
+        response = await response
+    # handlers (or templates) that return a coroutine on cpython
+    while type(response).__name__ == "coroutine":
+      response = await response
+  except Exception:
+    # counted against the route here, the client is sent a 500 by
+    # _handle_request
+    metrics.record(route and route.stats, 500, time.ticks_diff(time.ticks_ms(), request_start_time), 0)
+    raise
+  finally:
+    # uploads the handler didn't move out of the way are thrown away
+    if request.file:
+      await _remove_uploads(request)
+    if profile:
+      profile.mark(HANDLER)
+
+  # serve precompressed copies of files and static templates
+  if isinstance(response, (FileResponse, TemplateResponse)):
+    response = response.negotiate_encoding(request.headers.get("accept-encoding", ""))
+
+  # answer conditional requests without reading the file or template
+  if request.method == "GET" and isinstance(response, Response) and \
+      response.status == 200 and _not_modified(request, response):
+    headers = {}
+    for name in _not_modified_headers:
+      if name in response.headers:
+        headers[name] = response.headers[name]
+    response = Response("", 304, headers)
+
+  if isinstance(response, FileResponse) and "range" in request.headers:
+    response.set_range(request.headers["range"], request.headers.get("if-range"))
 
   # if shorthand body generator only notation used then convert to tuple
   if type(response).__name__ == "generator":
@@ -270,11 +977,43 @@ async def _handle_request(reader, writer):
     content_type = response[2] if len(response) >= 3 else "text/html"
     response = Response(body, status=status)
     response.add_header("Content-Type", content_type)
-    if hasattr(body, '__len__'):
-      response.add_header("Content-Length", len(body))
-  
+
+  # string bodies are sent as bytes so the length is exact
+  if isinstance(response.body, str):
+    response.body = response.body.encode("utf-8")
+  # a 304 has no body, and a Content-Length on it would be taken as the
+  # length of the cached copy
+  if isinstance(response.body, bytes) and not isinstance(response, FileResponse) and \
+      response.status != 304:
+    response.headers["Content-Length"] = len(response.body)
+
+  # streamed bodies are sent chunked to HTTP/1.1 clients so the end of the
+  # body can be found without closing the connection
+  asynchronous = hasattr(response.body, "__aiter__")
+  streamed = (type(response.body).__name__ == "generator" or asynchronous) and \
+    not isinstance(response, FileResponse)
+  chunked = streamed and protocol == "HTTP/1.1" and \
+    "Content-Length" not in response.headers
+  if chunked:
+    response.headers["Transfer-Encoding"] = "chunked"
+
+  # the connection can only be reused if the client wants it to be and
+  # the end of the response body can be found without closing it
+  connection = request.headers.get("connection", "").lower()
+  if protocol == "HTTP/1.1":
+    keep_alive = keep_alive and "close" not in connection
+  else:
+    keep_alive = keep_alive and "keep-alive" in connection
+  keep_alive = keep_alive and ("Content-Length" in response.headers or chunked or response.status == 304)
+  if keep_alive:
+    response.headers["Connection"] = "keep-alive"
+    response.headers["Keep-Alive"] = f"timeout={_keepalive_timeout}"
+  else:
+    response.headers["Connection"] = "close"
+
   # write status line
   status_message = status_message_map.get(response.status, "Unknown")
+  output.responding = True
   writer.write(f"HTTP/1.1 {response.status} {status_message}\r\n".encode("ascii"))
 
   # write headers
@@ -284,43 +1023,217 @@ async def _handle_request(reader, writer):
   # blank line to denote end of headers
   writer.write("\r\n".encode("ascii"))
  
-  if isinstance(response, FileResponse):
-    # file
-    with open(response.file, "rb") as f:
-      while True:
-        chunk = f.read(1024)
-        if not chunk:
+  sent = 0
+  if isinstance(response, FileResponse) and response.length:
+    # file (or the requested range of it), streamed through the shared
+    # buffer. reads from a storage object may be awaited, letting other
+    # connections run, so those use the connection's own buffer
+    if response.storage:
+      output.start(False)
+      view = output.view
+      f = response.storage.open(response.file, "rb")
+    else:
+      view = _file_buffer_view
+      f = open(response.file, "rb")
+    try:
+      if response.offset:
+        await _complete(f.seek(response.offset))
+      remaining = response.length
+      while remaining:
+        buffer = view
+        if remaining < len(buffer):
+          buffer = buffer[:remaining]
+        length = await _complete(f.readinto(buffer))
+        if not length:
           break
-        writer.write(chunk)
+        writer.write(buffer[:length])
+        if profile:
+          profile.mark(RENDER)
         await writer.drain()
-  elif type(response.body).__name__ == "generator":
-    # generator
-    for chunk in response.body:
-      writer.write(chunk)
-      await writer.drain()
+        if profile:
+          profile.mark(DRAIN)
+        remaining -= length
+        sent += length
+    finally:
+      await _complete(f.close())
+  elif streamed:
+    # generator, coalesced through the connection's output buffer
+    output.start(chunked)
+    if asynchronous:
+      # async generator body, can await between chunks
+      async for chunk in response.body:
+        if profile:
+          profile.mark(RENDER)
+        await output.write(chunk)
+        if profile:
+          profile.mark(DRAIN)
+    else:
+      for chunk in response.body:
+        if profile:
+          profile.mark(RENDER)
+        await output.write(chunk)
+        if profile:
+          profile.mark(DRAIN)
+    await output.finish()
+    if profile:
+      profile.mark(DRAIN)
+    sent = output.sent
   else:
     # string/bytes
     writer.write(response.body)
+    if profile:
+      profile.mark(RENDER)
     await writer.drain()
-  
-  writer.close()
-  await writer.wait_closed()
-  
-  processing_time = time.ticks_ms() - request_start_time
-  logging.info(f"> {request.method} {request.path} ({response.status} {status_message}) [{processing_time}ms]")
+    if profile:
+      profile.mark(DRAIN)
+    sent = len(response.body)
+
+  processing_time = time.ticks_diff(time.ticks_ms(), request_start_time)
+  metrics.record(route and route.stats, response.status, processing_time, sent)
+  if profile:
+    _profiler.report(request, response, profile)
+  logging.access(request.path, response.status, processing_time, f"> {request.method} {request.path} ({response.status} {status_message}) [{processing_time}ms]")
+
+  return keep_alive
+
+
+# handle an incoming connection to the web server, serving requests on it
+# until the client closes it, goes idle or asks for it to be closed
+async def _handle_request(reader, writer):
+  global _active_connections
+  _active_connections += 1
+
+  # connections over the limit are served a single request so that idle
+  # clients can't tie up all of the sockets
+  persistent = _keepalive_timeout and _active_connections <= _max_connections
+
+  reader = _RequestReader(reader, _buffer_size)
+  output = _BodyWriter(writer, _chunk_size)
+  try:
+    served = 0
+    while True:
+      try:
+        # wait for the client to start a request, idle persistent
+        # connections are closed quietly
+        timeout = _keepalive_timeout if served else _header_timeout
+        request_line = await uasyncio.wait_for(reader.readline(414), timeout)
+      except uasyncio.TimeoutError:
+        if not served:
+          await _send_error(writer, 408)
+        break
+      if not request_line:
+        break
+
+      served += 1
+      keep_alive = persistent and served < _keepalive_max_requests
+      if not await _serve_request(reader, writer, output, request_line, keep_alive):
+        break
+  except _RequestError as e:
+    logging.warn(f"> bad request ({e.status} {status_message_map.get(e.status)})")
+    metrics.record(None, e.status, 0, 0)
+    await _send_error(writer, e.status)
+  except Exception as e:
+    logging.error(f"> error handling request: {e}")
+    # a response that has started can only be cut short
+    if not output.responding:
+      try:
+        await _send_error(writer, 500)
+      except OSError:
+        pass
+  finally:
+    _active_connections -= 1
+    writer.close()
+    await writer.wait_closed()
 
 
 # adds a new route to the routing table
 def add_route(path, handler, methods=["GET"]):
-  global _routes
-  _routes.append(Route(path, handler, methods))
-  # descending complexity order so most complex routes matched first
-  _routes = sorted(_routes, key=lambda route: len(route.path_parts), reverse=True)
+  route = Route(path, handler, methods)
+  _routes.append(route)
+
+  if not route.parameter_names:
+    methods_table = _static_routes.setdefault(path, {})
+    for method in methods:
+      methods_table.setdefault(method, route)
+
+  node = _route_tree
+  for part in route.path_parts:
+    if part.startswith("<"):
+      if not node.parameter:
+        node.parameter = _RouteNode()
+      node = node.parameter
+    else:
+      if part not in node.children:
+        node.children[part] = _RouteNode()
+      node = node.children[part]
+
+  # first registration for a path and method wins
+  for method in methods:
+    node.methods.setdefault(method, route)
+
+
+# sends a profile of each request's phases (see phew.profiling) to sink,
+# any object with a report(request, response, profile) method such as
+# profiling.LogSink(). None turns profiling off
+def set_profiler(sink):
+  global _profiler
+  _profiler = sink
+
+
+# configures persistent connections. idle connections are closed after
+# `timeout` seconds and after serving `max_requests` requests, at most
+# `max_connections` are kept open at once. a timeout of 0 disables them
+def set_keepalive(timeout=10, max_requests=100, max_connections=4):
+  global _keepalive_timeout, _keepalive_max_requests, _max_connections
+  _keepalive_timeout = timeout
+  _keepalive_max_requests = max_requests
+  _max_connections = max_connections
+
+
+# configures request parsing. `buffer_size` bytes are allocated for each
+# connection and limit the length of the request line and of each header
+# line. bodies parsed into memory are limited to `max_body_size` bytes.
+# timeouts are in seconds for receiving all of the headers and the body
+def set_limits(buffer_size=1024, max_header_size=4096, max_body_size=8192,
+               header_timeout=10, body_timeout=20):
+  global _buffer_size, _max_header_size, _max_body_size
+  global _header_timeout, _body_timeout
+  _buffer_size = buffer_size
+  _max_header_size = max_header_size
+  _max_body_size = max_body_size
+  _header_timeout = header_timeout
+  _body_timeout = body_timeout
+
+
+# sets the size of the buffer generator response bodies are collected in
+# before being sent. bigger buffers mean fewer, fuller TCP segments at the
+# cost of the memory held by each connection that streams a response
+def set_chunk_size(size=1024):
+  global _chunk_size
+  _chunk_size = size
+
+
+# enables streaming file uploads. files sent as multipart/form-data are
+# written to temporary files in `directory` and described in request.file
+# as a dict of "filename", "path", "size" and "content_type" by field name.
+# handlers should move the file (os.rename) to keep it, otherwise it's
+# removed once the handler returns. uploads over `max_size` bytes are
+# rejected with 413. `progress` is called as progress(filename,
+# bytes_received, content_length) while the file is written. `storage`, an
+# object with open(path, mode), exists(path) and remove(path) methods (such as
+# sdworker.SDWorker), writes the files through it instead of directly
+def set_uploads(directory, max_size=1024 * 1024, progress=None, storage=None):
+  global _upload_dir, _max_upload_size, _upload_progress, _upload_storage
+  _upload_dir = directory
+  _max_upload_size = max_size
+  _upload_progress = progress
+  _upload_storage = storage
 
 
 def set_callback(handler):
-  global catchall_handler
+  global catchall_handler, _catchall_is_async
   catchall_handler = handler
+  _catchall_is_async = _is_async(handler)
 
 
 # decorator shorthand for adding a route
@@ -349,6 +1262,7 @@ def serve_file(file):
 
 def run(host = "0.0.0.0", port = 80):
   logging.info("> starting web server on port {}".format(port))
+  loop.create_task(logging.flusher())
   loop.create_task(uasyncio.start_server(_handle_request, host, port))
   loop.run_forever()
 
@@ -1,65 +1,128 @@
+import os
 from . import logging
 
-async def render_template(template, **kwargs):
-  import time
-  start_time = time.ticks_ms()
+# compiled templates keyed by path. each entry is a list of
+# [mtime, segments, last_used] where segments is a list of static byte
+# strings and (name, code) tuples for each {{ }} tag
+_cache = {}
+_cache_size = 8
+_cache_tick = 0
+
+
+def set_cache_size(size):
+  global _cache_size
+  _cache_size = size
+  while len(_cache) > _cache_size:
+    _evict()
+
+
+def clear_cache():
+  _cache.clear()
+
 
+# drops the least recently used compiled template
+def _evict():
+  oldest = None
+  for path, entry in _cache.items():
+    if oldest is None or entry[2] < _cache[oldest][2]:
+      oldest = path
+  if oldest is not None:
+    del _cache[oldest]
+
+
+# parse a template file into static segments and precompiled expressions
+def _compile(template):
   with open(template, "rb") as f:
     # read the whole template file, we could work on single lines but
     # the performance is much worse - so long as our templates are
     # just a handful of kB it's ok to do this
     data = f.read()
-    token_caret = 0
-
-    while True:
-      # find the next tag that needs evaluating
-      start = data.find(b"{{", token_caret)
-      end = data.find(b"}}", start)
-
-      match = start != -1 and end != -1
-
-      # no more magic to handle, just return what's left
-      if not match:
-        yield data[token_caret:]
-        break
-
-      expression = data[start + 2:end].strip()
-
-      # output the bit before the tag
-      yield data[token_caret:start]
-
-      # merge locals with the supplied named arguments and
-      # the response object
-      params = {}
-      params.update(locals())
-      params.update(kwargs)
-      #params["response"] = response
-
-      # parse the expression
-      try:
-        if expression.decode("utf-8") in params:
-          result = params[expression.decode("utf-8")]
-          result = result.replace("&", "&amp;")
-          result = result.replace('"', "&quot;")
-          result = result.replace("'", "&apos;")
-          result = result.replace(">", "&gt;")
-          result = result.replace("<", "&lt;")
-        else:
-          result = eval(expression, globals(), params)
-
-        if type(result).__name__ == "generator":
-          # if expression returned a generator then iterate it fully
-          # and yield each result
-          for chunk in result:
-            yield chunk
-        else:
-          # yield the result of the expression
-          if result is not None:
-            yield str(result)
-      except:
-        pass
-
-      # discard the parsed bit
-      token_caret = end + 2
-
-  logging.debug("> parsed template:", template, "(took", time.ticks_ms() - start_time, "ms)")
\ No newline at end of file
+
+  segments = []
+  token_caret = 0
+  while True:
+    # find the next tag that needs evaluating
+    start = data.find(b"{{", token_caret)
+    end = data.find(b"}}", start)
+
+    # no more magic to handle, keep what's left
+    if start == -1 or end == -1:
+      if token_caret < len(data):
+        segments.append(data[token_caret:])
+      break
+
+    if start > token_caret:
+      segments.append(data[token_caret:start])
+
+    name = data[start + 2:end].strip().decode("utf-8")
+    try:
+      code = compile(name, template, "eval")
+    except:
+      # leave broken expressions to fail (silently) at render time
+      # like they always have
+      code = name
+    segments.append((name, code))
+
+    # discard the parsed bit
+    token_caret = end + 2
+
+  return segments
+
+
+# returns the compiled segments for a template, recompiling it only if
+# the file has been modified since it was cached
+def _load(template):
+  global _cache_tick
+  _cache_tick += 1
+  mtime = os.stat(template)[8]
+  entry = _cache.get(template)
+  if entry is None or entry[0] != mtime:
+    if entry is None and _cache_size and len(_cache) >= _cache_size:
+      _evict()
+    entry = [mtime, _compile(template), _cache_tick]
+    if _cache_size:
+      _cache[template] = entry
+  entry[2] = _cache_tick
+  return entry[1]
+
+
+def _escape(text):
+  text = text.replace("&", "&amp;")
+  text = text.replace('"', "&quot;")
+  text = text.replace("'", "&apos;")
+  text = text.replace(">", "&gt;")
+  return text.replace("<", "&lt;")
+
+
+# note: a plain generator, micropython treats `async def` functions that
+# yield exactly the same way so this is no change on the device
+def render_template(template, **kwargs):
+  import time
+  start_time = time.ticks_ms()
+
+  for segment in _load(template):
+    if type(segment) is bytes:
+      yield segment
+      continue
+
+    name, code = segment
+    # parse the expression
+    try:
+      if name in kwargs:
+        result = _escape(kwargs[name])
+      else:
+        result = eval(code, globals(), kwargs)
+
+      if type(result).__name__ == "generator":
+        # if expression returned a generator then iterate it fully
+        # and yield each result
+        for chunk in result:
+          yield chunk
+      else:
+        # yield the result of the expression
+        if result is not None:
+          yield str(result)
+    except:
+      pass
+
+  logging.debug("> parsed template:", template, "(took", time.ticks_ms() - start_time, "ms)")
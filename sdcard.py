@@ -15,7 +15,7 @@ https://core-electronics.com.au/guides/makerverse-micro-sd-adapter-micropython-g
 """
 
 from micropython import const # type: ignore
-import time
+import array, micropython, time # type: ignore
 
 
 _CMD_TIMEOUT = const(1000)
@@ -30,22 +30,128 @@ _R1_ILLEGAL_COMMAND = const(1 << 2)
 _TOKEN_CMD25 = const(0xFC)
 _TOKEN_STOP_TRAN = const(0xFD)
 _TOKEN_DATA = const(0xFE)
+_ERASE_TIMEOUT_MS = const(30000)
+_ERASE_MAX_BLOCKS = const(8192)
+_READ_TIMEOUT_MS = const(250)
+
+# SPI clock rates tried when negotiating, fastest last
+_BAUDRATES = (1000000, 4000000, 8000000, 12000000, 16000000, 20000000, 25000000, 50000000)
+
+# CSD TRAN_SPEED decoding: rate units in bit/s and multipliers (x10)
+_TRAN_SPEED_UNITS = (100000, 1000000, 10000000, 100000000)
+_TRAN_SPEED_MULTIPLIERS = (0, 10, 12, 13, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 70, 80)
+
+
+def _make_crc16_table():
+    table = array.array("H", [0] * 256)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+        table[i] = crc
+    return table
+
+
+_CRC16_TABLE = _make_crc16_table()
+
+
+# CRC-16-CCITT (XModem) as used for SD card data blocks
+def _crc16_python(buf):
+    crc = 0
+    table = _CRC16_TABLE
+    for b in buf:
+        crc = ((crc << 8) & 0xFF00) ^ table[(crc >> 8) ^ b]
+    return crc
+
+
+# the same using the viper code emitter, around 20x faster on the Pico
+@micropython.viper
+def _crc16_viper(buf, length: int) -> int:
+    data = ptr8(buf)
+    table = ptr16(_CRC16_TABLE)
+    crc = 0
+    for i in range(length):
+        crc = ((crc << 8) & 0xFF00) ^ table[((crc >> 8) ^ data[i]) & 0xFF]
+    return crc
+
+
+def _crc16_fast(buf):
+    return _crc16_viper(buf, len(buf))
+
+
+# use the viper version where it's available and gives the right answer
+crc16 = _crc16_python
+try:
+    if _crc16_fast(b"123456789") == 0x31C3:
+        crc16 = _crc16_fast
+except Exception:
+    pass
+
+
+# CRC7 for commands, once CMD59 turns on crc checking. the table works on
+# the crc shifted up one bit so the result is ready to OR with the end bit
+def _make_crc7_table():
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x12 if crc & 0x80 else crc << 1) & 0xFF
+        table[i] = crc
+    return table
+
+
+_CRC7_TABLE = _make_crc7_table()
 
 
 class SDCard:
-    def __init__(self, spi, cs, baudrate=1000000):
+    # if max_baudrate is given the SPI clock is stepped up from baudrate to
+    # the fastest rate (up to max_baudrate and the card's TRAN_SPEED) that
+    # reads back a block with a valid CRC.
+    #
+    # with crc=True the card is asked to check command and write CRCs
+    # (CMD59), read blocks are checked against theirs, and transfers that
+    # fail are retried up to `retries` times. repeated failures step the
+    # SPI clock back down. see stats() for the counters
+    def __init__(self, spi, cs, baudrate=1000000, max_baudrate=None, crc=False, retries=3):
         self.spi = spi
         self.cs = cs
+        self.crc = False
+        self.retries = retries
+        self.min_baudrate = baudrate
+
+        self.crc_errors = 0
+        self.write_errors = 0
+        self.retried = 0
+        self.failures = 0
+        self.downshifts = 0
 
         self.cmdbuf = bytearray(6)
         self.dummybuf = bytearray(512)
         self.tokenbuf = bytearray(1)
+        self.crcbuf = bytearray(2)
         for i in range(512):
             self.dummybuf[i] = 0xFF
         self.dummybuf_memoryview = memoryview(self.dummybuf)
 
+        # run of blocks waiting to be erased, consecutive erase requests
+        # from the filesystem are coalesced into one CMD38
+        self.erase_start = 0
+        self.erase_count = 0
+
+        # waiting for a data token: spin for poll_spins reads then sleep
+        # poll_sleep_us between reads, see set_poll()
+        self.poll_spins = 100
+        self.poll_sleep_us = 100
+
         # initialise the card
         self.init_card(baudrate)
+        if crc:
+            self.crc = True
+            # CMD59: turn on crc checking
+            if self.cmd(59, 1, 0) != 0:
+                raise OSError("couldn't enable SD card CRC checking")
+        if max_baudrate:
+            self.negotiate_baudrate(max_baudrate)
 
     def init_spi(self, baudrate):
         try:
@@ -91,6 +197,7 @@ class SDCard:
             raise OSError("no response from SD card")
         csd = bytearray(16)
         self.readinto(csd)
+        self.csd = csd
         if csd[0] & 0xC0 == 0x40:  # CSD version 2.0
             self.sectors = ((csd[8] << 8 | csd[9]) + 1) * 1024
         elif csd[0] & 0xC0 == 0x00:  # CSD version 1.0 (old, <=2GB)
@@ -107,6 +214,67 @@ class SDCard:
 
         # set to high data rate now that it's initialised
         self.init_spi(baudrate)
+        self.baudrate = baudrate
+
+    # the maximum transfer rate from the CSD TRAN_SPEED field, in bit/s
+    def tran_speed(self):
+        speed = self.csd[3]
+        return _TRAN_SPEED_UNITS[speed & 0x03] * _TRAN_SPEED_MULTIPLIERS[(speed >> 3) & 0x0F] // 10
+
+    # read block 0 twice and check the data against its CRC
+    def _test_read(self, buf):
+        try:
+            for _ in range(2):
+                if self.cmd(17, 0, 0, release=False) != 0:
+                    self.cs(1)
+                    return False
+                self.readinto(buf)
+                if crc16(buf) != (self.crcbuf[0] << 8 | self.crcbuf[1]):
+                    return False
+        except OSError:
+            return False
+        return True
+
+    # step the SPI clock up until a test read fails, falling back to the
+    # last rate that worked
+    def negotiate_baudrate(self, max_baudrate):
+        limit = min(max_baudrate, self.tran_speed() or max_baudrate)
+        buf = bytearray(512)
+        for baudrate in _BAUDRATES:
+            if baudrate <= self.baudrate or baudrate > limit:
+                continue
+            self.init_spi(baudrate)
+            if not self._test_read(buf):
+                break
+            self.baudrate = baudrate
+        self.init_spi(self.baudrate)
+        return self.baudrate
+
+    # tune how readinto waits for a data token: spins polls back to back,
+    # then sleeps sleep_us between polls (0 to never sleep)
+    def set_poll(self, spins, sleep_us):
+        self.poll_spins = spins
+        self.poll_sleep_us = sleep_us
+
+    # drop to the next slower clock rate after repeated transfer failures
+    def step_down(self):
+        for baudrate in reversed(_BAUDRATES):
+            if self.min_baudrate <= baudrate < self.baudrate:
+                self.baudrate = baudrate
+                self.init_spi(baudrate)
+                self.downshifts += 1
+                return True
+        return False
+
+    def stats(self):
+        return {
+            "baudrate": self.baudrate,
+            "crc_errors": self.crc_errors,
+            "write_errors": self.write_errors,
+            "retries": self.retried,
+            "failures": self.failures,
+            "downshifts": self.downshifts,
+        }
 
     def init_card_v1(self):
         for i in range(_CMD_TIMEOUT):
@@ -135,10 +303,15 @@ class SDCard:
         # create and send the command
         buf = self.cmdbuf
         buf[0] = 0x40 | cmd
-        buf[1] = arg >> 24
-        buf[2] = arg >> 16
-        buf[3] = arg >> 8
-        buf[4] = arg
+        buf[1] = (arg >> 24) & 0xFF
+        buf[2] = (arg >> 16) & 0xFF
+        buf[3] = (arg >> 8) & 0xFF
+        buf[4] = arg & 0xFF
+        if self.crc:
+            crc = 0
+            for i in range(5):
+                crc = _CRC7_TABLE[crc ^ buf[i]]
+            crc |= 1
         buf[5] = crc
         self.spi.write(buf)
 
@@ -163,16 +336,27 @@ class SDCard:
         self.spi.write(b"\xff")
         return -1
 
-    def readinto(self, buf):
-        self.cs(0)
+    # wait for the start of data token, returns False on timeout
+    def _wait_token(self):
+        for i in range(self.poll_spins):
+            self.spi.readinto(self.tokenbuf, 0xFF)
+            if self.tokenbuf[0] == _TOKEN_DATA:
+                return True
 
-        # read until start byte (0xff)
-        for i in range(_CMD_TIMEOUT):
+        start = time.ticks_ms()
+        while time.ticks_diff(time.ticks_ms(), start) < _READ_TIMEOUT_MS:
             self.spi.readinto(self.tokenbuf, 0xFF)
             if self.tokenbuf[0] == _TOKEN_DATA:
-                break
-            time.sleep(0.0001)
-        else:
+                return True
+            if self.poll_sleep_us:
+                time.sleep_us(self.poll_sleep_us)
+        return False
+
+    def readinto(self, buf):
+        self.cs(0)
+
+        # read until start byte (0xfe)
+        if not self._wait_token():
             self.cs(1)
             raise OSError("timeout waiting for response")
 
@@ -183,26 +367,40 @@ class SDCard:
         self.spi.write_readinto(mv, buf)
 
         # read checksum
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
+        self.spi.readinto(self.crcbuf, 0xFF)
 
         self.cs(1)
         self.spi.write(b"\xff")
 
+        if self.crc and crc16(buf) != (self.crcbuf[0] << 8 | self.crcbuf[1]):
+            self.crc_errors += 1
+            raise OSError(5)  # EIO
+
     def write(self, token, buf):
         self.cs(0)
 
         # send: start of block, data, checksum
         self.spi.read(1, token)
         self.spi.write(buf)
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
+        if self.crc:
+            crc = crc16(buf)
+            self.crcbuf[0] = crc >> 8
+            self.crcbuf[1] = crc & 0xFF
+            self.spi.write(self.crcbuf)
+        else:
+            self.spi.write(b"\xff")
+            self.spi.write(b"\xff")
 
-        # check the response
-        if (self.spi.read(1, 0xFF)[0] & 0x1F) != 0x05:
+        # check the response, 0x0B is a crc error and 0x0D a write error
+        response = self.spi.read(1, 0xFF)[0] & 0x1F
+        if response != 0x05:
             self.cs(1)
             self.spi.write(b"\xff")
-            return
+            if response == 0x0B:
+                self.crc_errors += 1
+            else:
+                self.write_errors += 1
+            raise OSError(5)  # EIO
 
         # wait for write to finish
         while self.spi.read(1, 0xFF)[0] == 0:
@@ -222,7 +420,69 @@ class SDCard:
         self.cs(1)
         self.spi.write(b"\xff")
 
+    # erase count blocks starting at block_num: CMD32 and CMD33 set the
+    # first and last address and CMD38 erases everything between them
+    def erase(self, block_num, count):
+        if self.cmd(32, block_num * self.cdv, 0) != 0:
+            raise OSError(5)  # EIO
+        if self.cmd(33, (block_num + count - 1) * self.cdv, 0) != 0:
+            raise OSError(5)  # EIO
+        if self.cmd(38, 0, 0, release=False) != 0:
+            self.cs(1)
+            raise OSError(5)  # EIO
+
+        # the card holds the data line low until the erase is finished
+        start = time.ticks_ms()
+        while self.spi.read(1, 0xFF)[0] == 0:
+            if time.ticks_diff(time.ticks_ms(), start) > _ERASE_TIMEOUT_MS:
+                self.cs(1)
+                self.spi.write(b"\xff")
+                raise OSError(5)  # EIO
+            time.sleep_ms(1)
+
+        self.cs(1)
+        self.spi.write(b"\xff")
+
+    def flush_erase(self):
+        if self.erase_count:
+            start, count = self.erase_start, self.erase_count
+            self.erase_count = 0
+            self.erase(start, count)
+
+    def queue_erase(self, block_num):
+        if self.erase_count and block_num == self.erase_start + self.erase_count:
+            self.erase_count += 1
+            if self.erase_count >= _ERASE_MAX_BLOCKS:
+                self.flush_erase()
+            return
+        self.flush_erase()
+        self.erase_start = block_num
+        self.erase_count = 1
+
+    # run a transfer, retrying it if it fails and slowing the clock down if
+    # it keeps failing
+    def _retry(self, transfer, block_num, buf):
+        self.flush_erase()
+        attempt = 0
+        while True:
+            try:
+                return transfer(block_num, buf)
+            except OSError:
+                if attempt >= self.retries:
+                    self.failures += 1
+                    raise
+                attempt += 1
+                self.retried += 1
+                if attempt > 1:
+                    self.step_down()
+
     def readblocks(self, block_num, buf):
+        return self._retry(self._readblocks, block_num, buf)
+
+    def writeblocks(self, block_num, buf):
+        return self._retry(self._writeblocks, block_num, buf)
+
+    def _readblocks(self, block_num, buf):
         nblocks = len(buf) // 512
         assert nblocks and not len(buf) % 512, "Buffer length is invalid"
         if nblocks == 1:
@@ -241,15 +501,18 @@ class SDCard:
                 raise OSError(5)  # EIO
             offset = 0
             mv = memoryview(buf)
-            while nblocks:
-                # receive the data and release card
-                self.readinto(mv[offset : offset + 512])
-                offset += 512
-                nblocks -= 1
-            if self.cmd(12, 0, 0xFF, skip1=True):
-                raise OSError(5)  # EIO
-
-    def writeblocks(self, block_num, buf):
+            try:
+                while nblocks:
+                    # receive the data and release card
+                    self.readinto(mv[offset : offset + 512])
+                    offset += 512
+                    nblocks -= 1
+            finally:
+                # CMD12: stop the transfer, even if a block failed
+                if self.cmd(12, 0, 0xFF, skip1=True):
+                    raise OSError(5)  # EIO
+
+    def _writeblocks(self, block_num, buf):
         nblocks, err = divmod(len(buf), 512)
         assert nblocks and not err, "Buffer length is invalid"
         if nblocks == 1:
@@ -266,12 +529,221 @@ class SDCard:
             # send the data
             offset = 0
             mv = memoryview(buf)
-            while nblocks:
-                self.write(_TOKEN_CMD25, mv[offset : offset + 512])
-                offset += 512
-                nblocks -= 1
+            try:
+                while nblocks:
+                    self.write(_TOKEN_CMD25, mv[offset : offset + 512])
+                    offset += 512
+                    nblocks -= 1
+            finally:
+                self.write_token(_TOKEN_STOP_TRAN)
+
+    # write consecutive blocks from separate 512 byte buffers with a single
+    # CMD25, so callers don't need to gather them into one buffer first
+    def write_multiple(self, block_num, buffers):
+        return self._retry(self._write_multiple, block_num, buffers)
+
+    def _write_multiple(self, block_num, buffers):
+        # CMD25: set write address for first block
+        if self.cmd(25, block_num * self.cdv, 0) != 0:
+            raise OSError(5)  # EIO
+        try:
+            for buf in buffers:
+                self.write(_TOKEN_CMD25, buf)
+        finally:
             self.write_token(_TOKEN_STOP_TRAN)
 
     def ioctl(self, op, arg):
+        if op == 1:  # init
+            return 0
+        if op == 2 or op == 3:  # deinit, sync
+            self.flush_erase()
+            return 0
         if op == 4:  # get number of blocks
-            return self.sectors
\ No newline at end of file
+            return self.sectors
+        if op == 5:  # get block size in bytes
+            return 512
+        if op == 6:  # erase block arg
+            self.queue_erase(arg)
+            return 0
+
+
+# Optional write-back cache of 512 byte sectors that sits between the VFS
+# and an SDCard, mount it in place of the card:
+#
+#     sd = sdcard.BlockCache(sdcard.SDCard(spi, cs), sectors=16)
+#     os.mount(sd, "/sd")
+#
+# Recently used sectors (the FAT and directory entries in particular) are
+# served from RAM. Sequential reads prefetch the next `readahead` sectors
+# with one CMD18, and writes are held until the VFS syncs (or a dirty
+# sector has to be evicted) and then written back in runs with CMD25.
+# Transfers of at least half the cache go straight to the card so that
+# streaming a large file doesn't flush out the metadata.
+class BlockCache:
+    def __init__(self, sd, sectors=16, readahead=4):
+        self.sd = sd
+        self.sectors = sectors
+        self.readahead = readahead
+        self.bypass = max(sectors // 2, 1)
+
+        self.pool = bytearray(sectors * 512)
+        self.pool_memoryview = memoryview(self.pool)
+        self.blocks = [-1] * sectors  # block held in each slot
+        self.used = [0] * sectors  # when each slot was last used
+        self.dirty = bytearray(sectors)
+        self.slots = {}  # block -> slot
+        self.tick = 0
+        if readahead:
+            self.aheadbuf = bytearray(readahead * 512)
+            self.aheadbuf_memoryview = memoryview(self.aheadbuf)
+        self.next_block = -1
+
+        self.hits = 0
+        self.misses = 0
+        self.readaheads = 0
+        self.writebacks = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "readaheads": self.readaheads,
+            "writebacks": self.writebacks,
+            "evictions": self.evictions,
+            "dirty": sum(self.dirty),
+        }
+
+    def _slot_memoryview(self, slot):
+        return self.pool_memoryview[slot * 512 : slot * 512 + 512]
+
+    # returns a slot for block, evicting the least recently used sector
+    # (and writing back dirty sectors first if it is one of them)
+    def _allocate(self, block):
+        slot = 0
+        for i in range(1, self.sectors):
+            if self.used[i] < self.used[slot]:
+                slot = i
+        old = self.blocks[slot]
+        if old != -1:
+            if self.dirty[slot]:
+                self.flush()
+            del self.slots[old]
+            self.evictions += 1
+        self.blocks[slot] = block
+        self.slots[block] = slot
+        return slot
+
+    def _store(self, block, data, dirty):
+        slot = self.slots.get(block)
+        if slot is None:
+            slot = self._allocate(block)
+        self._slot_memoryview(slot)[:] = data
+        if dirty:
+            self.dirty[slot] = 1
+        self.tick += 1
+        self.used[slot] = self.tick
+
+    def _read_ahead(self, block_num):
+        count = 0
+        while (
+            count < self.readahead
+            and block_num + count < self.sd.sectors
+            and block_num + count not in self.slots
+        ):
+            count += 1
+        if not count:
+            return
+        # CMD18 for the whole run (or CMD17 for one block)
+        mv = self.aheadbuf_memoryview
+        self.sd.readblocks(block_num, mv[: count * 512])
+        for i in range(count):
+            self._store(block_num + i, mv[i * 512 : i * 512 + 512], False)
+        self.readaheads += count
+
+    def readblocks(self, block_num, buf):
+        nblocks = len(buf) // 512
+        assert nblocks and not len(buf) % 512, "Buffer length is invalid"
+        mv = memoryview(buf)
+        i = 0
+        while i < nblocks:
+            slot = self.slots.get(block_num + i)
+            if slot is not None:
+                self.hits += 1
+                self.tick += 1
+                self.used[slot] = self.tick
+                mv[i * 512 : i * 512 + 512] = self._slot_memoryview(slot)
+                i += 1
+                continue
+
+            # read the run of blocks that aren't cached in one go
+            j = i + 1
+            while j < nblocks and block_num + j not in self.slots:
+                j += 1
+            self.misses += j - i
+            self.sd.readblocks(block_num + i, mv[i * 512 : j * 512])
+            if j - i < self.bypass:
+                for k in range(i, j):
+                    self._store(block_num + k, mv[k * 512 : k * 512 + 512], False)
+            i = j
+
+        end = block_num + nblocks
+        if self.readahead and block_num == self.next_block and nblocks < self.bypass:
+            self._read_ahead(end)
+        self.next_block = end
+
+    def writeblocks(self, block_num, buf):
+        nblocks, err = divmod(len(buf), 512)
+        assert nblocks and not err, "Buffer length is invalid"
+        mv = memoryview(buf)
+        if nblocks >= self.bypass:
+            # large writes go straight to the card, any cached copies are
+            # updated and are now clean
+            self.sd.writeblocks(block_num, buf)
+            for i in range(nblocks):
+                slot = self.slots.get(block_num + i)
+                if slot is not None:
+                    self._slot_memoryview(slot)[:] = mv[i * 512 : i * 512 + 512]
+                    self.dirty[slot] = 0
+            return
+        for i in range(nblocks):
+            self._store(block_num + i, mv[i * 512 : i * 512 + 512], True)
+
+    # write all dirty sectors back to the card, consecutive sectors are
+    # coalesced into a single CMD25
+    def flush(self):
+        dirty = sorted(self.blocks[slot] for slot in range(self.sectors) if self.dirty[slot])
+        i = 0
+        while i < len(dirty):
+            j = i + 1
+            while j < len(dirty) and dirty[j] == dirty[j - 1] + 1:
+                j += 1
+            slots = [self.slots[block] for block in dirty[i:j]]
+            if len(slots) == 1:
+                self.sd.writeblocks(dirty[i], self._slot_memoryview(slots[0]))
+            else:
+                self.sd.write_multiple(dirty[i], [self._slot_memoryview(slot) for slot in slots])
+            for slot in slots:
+                self.dirty[slot] = 0
+            self.writebacks += j - i
+            i = j
+
+    # drop cached copies of blocks that are being erased, even dirty ones
+    def _discard(self, block_num, count):
+        for block in range(block_num, block_num + count):
+            slot = self.slots.pop(block, None)
+            if slot is not None:
+                self.blocks[slot] = -1
+                self.used[slot] = 0
+                self.dirty[slot] = 0
+
+    def erase(self, block_num, count):
+        self._discard(block_num, count)
+        self.sd.erase(block_num, count)
+
+    def ioctl(self, op, arg):
+        if op == 2 or op == 3:  # deinit, sync
+            self.flush()
+        elif op == 6:  # erase block arg
+            self._discard(arg, 1)
+        return self.sd.ioctl(op, arg)
@@ -0,0 +1,157 @@
+"""
+In-memory index of the files in one directory on the SD card.
+
+Listing a FAT directory reads its sectors over SPI, and main.py lists /sd
+on nearly every page. The index reads the directory once, at mount, and
+keeps each file's mode, size and mtime in a dict, so listings, existence
+checks and stats of files in the directory don't touch the card. The
+app's own writes, copies, renames and removes go through the index, which
+runs them on the SD worker and then updates the entries they changed.
+
+The directory is read again when:
+  - ttl_ms has passed since it was last read, to pick up changes made
+    some other way (like the card being edited on a computer)
+  - invalidate() is called
+  - a change fails, as the card and the index may no longer agree
+
+Paths outside the directory are passed straight through to the worker.
+
+    index = SDIndex(worker, "/sd")
+    index.build()                          # blocking, at mount
+    names = await index.names()            # sorted, without dotfiles
+    if await index.exists("/sd/a.json"):
+        await index.rename("/sd/a.json", "/sd/b.json")
+"""
+
+import os, time # type: ignore
+
+
+# reads the mode, size and mtime of everything in path
+def scan(path):
+    entries = {}
+    for name in os.listdir(path):
+        entries[name] = _entry(f"{path}/{name}")
+    return entries
+
+
+def _entry(path):
+    stat = os.stat(path)
+    return (stat[0], stat[6], stat[8])
+
+
+class SDIndex:
+    def __init__(self, worker, path, ttl_ms=60000):
+        self.worker = worker
+        self.path = path
+        self.ttl_ms = ttl_ms
+        self.entries = None
+        self.valid = False
+        self.loaded = 0
+        # sorted names without dotfiles, made on the first listing after
+        # a change
+        self.listing = None
+        # counts changes so a scan that overlaps one can be spotted
+        self.changes = 0
+        self.scans = 0
+
+    # reads the directory and blocks until it's done, for start up
+    def build(self):
+        self._load(self.worker.call(scan, self.path), self.changes)
+
+    async def refresh(self):
+        changes = self.changes
+        self._load(await self.worker.run(scan, self.path), changes)
+
+    def _load(self, entries, changes):
+        self.entries = entries
+        self.listing = None
+        self.loaded = time.ticks_ms()
+        self.scans += 1
+        # a change made while the directory was being read may be missing
+        # from it, so read it again next time
+        self.valid = changes == self.changes
+
+    # forgets the contents, the directory is read again when next needed
+    def invalidate(self):
+        self.valid = False
+
+    async def _entries(self):
+        if not self.valid or time.ticks_diff(time.ticks_ms(), self.loaded) > self.ttl_ms:
+            await self.refresh()
+        return self.entries
+
+    # the name of path in the indexed directory, or None if it's elsewhere
+    def _name(self, path):
+        prefix = self.path + "/"
+        if path.startswith(prefix) and "/" not in path[len(prefix):]:
+            return path[len(prefix):]
+        return None
+
+    # sorted names in the directory. the list is shared, don't change it
+    async def names(self, hidden=False):
+        entries = await self._entries()
+        if hidden:
+            return sorted(entries)
+        if self.listing is None:
+            self.listing = sorted(name for name in entries if not name.startswith("."))
+        return self.listing
+
+    async def exists(self, path):
+        name = self._name(path)
+        if name is None:
+            return await self.worker.exists(path)
+        return name in await self._entries()
+
+    # an os.stat() style tuple, with the mode, size and times filled in
+    async def stat(self, path):
+        name = self._name(path)
+        if name is None:
+            return await self.worker.stat(path)
+        entry = (await self._entries()).get(name)
+        if entry is None:
+            raise OSError(2) # ENOENT
+        mode, size, mtime = entry
+        return (mode, 0, 0, 0, 0, 0, size, mtime, mtime, mtime)
+
+    def _set(self, path, entry):
+        name = self._name(path)
+        if name is None:
+            return
+        self.changes += 1
+        self.listing = None
+        if self.entries is not None:
+            if entry is None:
+                self.entries.pop(name, None)
+            else:
+                self.entries[name] = entry
+
+    # awaits a change on the worker, then updates the entries for the path
+    # it removed and the path it created or changed
+    async def _change(self, operation, removed=None, updated=None):
+        try:
+            result = await operation
+            if removed:
+                self._set(removed, None)
+            if updated and self._name(updated) is not None:
+                self._set(updated, await self.worker.run(_entry, updated))
+        except OSError:
+            self.invalidate()
+            raise
+        return result
+
+    async def write(self, path, data, mode="wb"):
+        return await self._change(self.worker.write(path, data, mode), updated=path)
+
+    async def copy(self, source, destination):
+        return await self._change(self.worker.copy(source, destination), updated=destination)
+
+    async def rename(self, old_path, new_path):
+        return await self._change(self.worker.rename(old_path, new_path), old_path, new_path)
+
+    async def remove(self, path):
+        return await self._change(self.worker.remove(path), removed=path)
+
+    # metrics lines for the index, see phew.metrics.add_source()
+    def render(self):
+        yield "sd_index_files {}\n".format(len(self.entries) if self.entries else 0)
+        yield "sd_index_scans {}\n".format(self.scans)
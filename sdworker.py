@@ -0,0 +1,308 @@
+"""
+SD card I/O worker for the RP2040's second core.
+
+The worker thread owns the SPI bus and the /sd mount: every file
+operation on the card is queued to it as a job and runs on core 1, while
+the web server keeps serving on core 0. Jobs are passed through a small
+lock-protected ring of slot numbers, and each slot has its own
+ThreadSafeFlag that the worker sets when the job is done so a uasyncio
+task can await the result.
+
+    worker = SDWorker()
+    worker.start()
+    worker.call(mount)                      # blocking, before the loop runs
+    names = await worker.listdir("/sd")     # from async code
+    worker.submit(function, arg)            # fire and forget
+
+Without _thread (or before start()) jobs run inline on the caller's core.
+"""
+
+import os, time, uasyncio # type: ignore
+try:
+    import _thread # type: ignore
+except ImportError:
+    _thread = None
+
+
+class _Job:
+    def __init__(self):
+        self.function = None
+        self.args = ()
+        self.result = None
+        self.error = None
+        self.done = False
+        self.detached = False
+        self.flag = uasyncio.ThreadSafeFlag()
+
+
+class SDWorker:
+    def __init__(self, queue_size=8, idle_ms=1):
+        self.idle_ms = idle_ms
+        self.lock = _thread.allocate_lock() if _thread else None
+        self.jobs = [_Job() for _ in range(queue_size)]
+        # slots that can take a new job. only touched on the event loop
+        # core, detached jobs are handed back through `returned`
+        self.free = list(range(queue_size))
+        self.returned = []
+        # ring of slots waiting for the worker
+        self.queue = [0] * queue_size
+        self.head = 0
+        self.count = 0
+        self.running = False
+        self.space = None
+
+        self.completed = 0
+        self.errors = 0
+        self.max_depth = 0
+
+    # starts the worker thread (on core 1 on the Pico)
+    def start(self):
+        if self.running or not _thread:
+            return
+        self.running = True
+        _thread.start_new_thread(self._run, ())
+
+    # asks the worker thread to finish once the queue is empty
+    def stop(self):
+        self.running = False
+
+    def stats(self):
+        return {
+            "queued": self.count,
+            "completed": self.completed,
+            "errors": self.errors,
+            "max_depth": self.max_depth,
+        }
+
+    # metrics lines for the queue, see phew.metrics.add_source()
+    def render(self):
+        yield "sd_worker_queued {}\n".format(self.count)
+        yield "sd_worker_completed {}\n".format(self.completed)
+        yield "sd_worker_errors {}\n".format(self.errors)
+        yield "sd_worker_max_depth {}\n".format(self.max_depth)
+
+    def _push(self, index):
+        self.lock.acquire()
+        self.queue[(self.head + self.count) % len(self.queue)] = index
+        self.count += 1
+        if self.count > self.max_depth:
+            self.max_depth = self.count
+        self.lock.release()
+
+    def _pop(self):
+        self.lock.acquire()
+        index = None
+        if self.count:
+            index = self.queue[self.head]
+            self.head = (self.head + 1) % len(self.queue)
+            self.count -= 1
+        self.lock.release()
+        return index
+
+    def _run(self):
+        while self.running or self.count:
+            index = self._pop()
+            if index is None:
+                time.sleep_ms(self.idle_ms)
+                continue
+            job = self.jobs[index]
+            # read before the job is run: once it's done the event loop
+            # can hand the slot to a new job
+            detached = job.detached
+            self._execute(job)
+            if detached:
+                self.lock.acquire()
+                self.returned.append(index)
+                self.lock.release()
+        self.running = False
+
+    def _execute(self, job):
+        try:
+            job.result = job.function(*job.args)
+        except Exception as e:
+            job.error = e
+            self.errors += 1
+        self.completed += 1
+        job.done = True
+        job.flag.set()
+
+    # takes a free slot for a new job, or None if they're all busy
+    def _take(self, function, args, detached=False):
+        if not self.free and self.returned:
+            self.lock.acquire()
+            self.free.extend(self.returned)
+            self.returned.clear()
+            self.lock.release()
+        if not self.free:
+            return None
+        index = self.free.pop()
+        job = self.jobs[index]
+        job.function = function
+        job.args = args
+        job.result = job.error = None
+        job.done = False
+        job.detached = detached
+        return index
+
+    def _collect(self, index):
+        job = self.jobs[index]
+        result, error = job.result, job.error
+        job.function = job.args = job.result = job.error = None
+        self.free.append(index)
+        if self.space:
+            self.space.set()
+        if error:
+            raise error
+        return result
+
+    # runs function(*args) on the worker and awaits its result. exceptions
+    # raised by the job are raised here
+    async def run(self, function, *args):
+        if not self.running:
+            return function(*args)
+        while True:
+            index = self._take(function, args)
+            if index is not None:
+                break
+            # every slot is busy, wait for one to be handed back
+            if self.space is None:
+                self.space = uasyncio.ThreadSafeFlag()
+            try:
+                await uasyncio.wait_for_ms(self.space.wait(), 10)
+            except uasyncio.TimeoutError:
+                pass
+        job = self.jobs[index]
+        self._push(index)
+        while not job.done:
+            await job.flag.wait()
+        return self._collect(index)
+
+    # runs function(*args) on the worker and blocks until it's done, for
+    # code that can't await (like start up, before the event loop runs)
+    def call(self, function, *args):
+        if not self.running:
+            return function(*args)
+        while True:
+            index = self._take(function, args)
+            if index is not None:
+                break
+            time.sleep_ms(self.idle_ms)
+        job = self.jobs[index]
+        self._push(index)
+        while not job.done:
+            time.sleep_ms(self.idle_ms)
+        job.flag.clear()
+        return self._collect(index)
+
+    # queues function(*args) without waiting for it. returns False if the
+    # queue is full
+    def submit(self, function, *args):
+        if not self.running:
+            function(*args)
+            return True
+        index = self._take(function, args, detached=True)
+        if index is None:
+            return False
+        self._push(index)
+        return True
+
+    # file operations, all run on the worker
+    async def listdir(self, path):
+        return await self.run(os.listdir, path)
+
+    async def stat(self, path):
+        return await self.run(os.stat, path)
+
+    async def exists(self, path):
+        return await self.run(_exists, path)
+
+    async def remove(self, path):
+        return await self.run(os.remove, path)
+
+    async def rename(self, old_path, new_path):
+        return await self.run(os.rename, old_path, new_path)
+
+    async def read(self, path, mode="rb"):
+        return await self.run(_read, path, mode)
+
+    async def write(self, path, data, mode="wb"):
+        return await self.run(_write, path, data, mode)
+
+    async def copy(self, source, destination):
+        return await self.run(_copy, source, destination)
+
+    # a file on the card for streaming (see phew.server's FileResponse and
+    # set_uploads). its methods are queued to the worker one at a time
+    def open(self, path, mode="rb"):
+        return _File(self, path, mode)
+
+
+# a missing file isn't an error, so it isn't counted as one
+def _exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+
+def _read(path, mode):
+    with open(path, mode) as f:
+        return f.read()
+
+
+def _write(path, data, mode):
+    if type(data) is str and "b" in mode:
+        data = data.encode("utf-8")
+    with open(path, mode) as f:
+        return f.write(data)
+
+
+def _copy(source, destination):
+    buffer = bytearray(512)
+    view = memoryview(buffer)
+    copied = 0
+    with open(source, "rb") as infile:
+        with open(destination, "wb") as outfile:
+            while True:
+                length = infile.readinto(buffer)
+                if not length:
+                    break
+                outfile.write(view[:length])
+                copied += length
+    return copied
+
+
+# file opened (lazily) on the worker. readinto/write are passed the
+# caller's buffer, which the caller must leave alone until they return
+class _File:
+    def __init__(self, worker, path, mode):
+        self.worker = worker
+        self.path = path
+        self.mode = mode
+        self.file = None
+        self.position = 0
+
+    async def _open(self):
+        if self.file is None:
+            self.file = await self.worker.run(open, self.path, self.mode)
+            if self.position:
+                await self.worker.run(self.file.seek, self.position)
+
+    def seek(self, offset):
+        self.position = offset
+        if self.file is not None:
+            return self.worker.run(self.file.seek, offset)
+
+    async def readinto(self, buffer):
+        await self._open()
+        return await self.worker.run(self.file.readinto, buffer)
+
+    async def write(self, data):
+        await self._open()
+        return await self.worker.run(self.file.write, data)
+
+    async def close(self):
+        if self.file is not None:
+            await self.worker.run(self.file.close)
+            self.file = None
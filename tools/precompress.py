@@ -0,0 +1,66 @@
+# build step: writes a gzip compressed copy (name + ".gz") of each static
+# asset so phew.server can send it to browsers that accept gzip without
+# compressing anything on the Pico. templates with {{ }} tags are rendered
+# per request and are skipped, as are files that gzip doesn't shrink.
+#
+#   python tools/precompress.py [directory ...]    (default: app_templates)
+#   python tools/precompress.py --clean [directory ...]
+#
+# run it again whenever an asset changes, the server ignores copies that
+# are older than the file they were made from
+import argparse, gzip, os, sys
+
+EXTENSIONS = (".html", ".htm", ".css", ".js", ".json", ".svg", ".txt", ".xml")
+
+
+def _is_template(data):
+  return b"{{" in data and b"}}" in data
+
+
+def compress(path, level=9):
+  with open(path, "rb") as f:
+    data = f.read()
+  if _is_template(data):
+    return "template"
+  # fixed mtime in the gzip header so the output only changes with the input
+  compressed = gzip.compress(data, compresslevel=level, mtime=0)
+  if len(compressed) >= len(data):
+    _remove(path + ".gz")
+    return "not smaller"
+  with open(path + ".gz", "wb") as f:
+    f.write(compressed)
+  return f"{len(data)} -> {len(compressed)} bytes"
+
+
+def _remove(path):
+  try:
+    os.remove(path)
+  except FileNotFoundError:
+    pass
+
+
+def assets(directories):
+  for directory in directories:
+    for root, _, files in os.walk(directory):
+      for name in sorted(files):
+        if name.lower().endswith(EXTENSIONS):
+          yield os.path.join(root, name)
+
+
+def main():
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  parser = argparse.ArgumentParser(description="precompress static assets for phew.server")
+  parser.add_argument("directories", nargs="*", default=[os.path.join(root, "app_templates")])
+  parser.add_argument("--clean", action="store_true", help="remove the .gz copies instead")
+  parser.add_argument("--level", type=int, default=9)
+  args = parser.parse_args()
+
+  for path in assets(args.directories):
+    if args.clean:
+      _remove(path + ".gz")
+    else:
+      print(f"{path}: {compress(path, args.level)}")
+
+
+if __name__ == "__main__":
+  sys.exit(main())